@@ -1,14 +1,23 @@
 #!/usr/bin/env python3
 
 import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 import difflib
-from functools import partial
+from functools import lru_cache
+import hashlib
+import io
+import json
+import os
+import time
+from xml.sax import saxutils
 
 import PyRSS2Gen
 import bbcode
 
-from database import NewsDatabase
+from database import NewsDatabase, SOURCE_SEP
+from metrics import RunMetrics
 
 # Generate RSS, see:
 # https://cyber.harvard.edu/rss/rss.html
@@ -18,38 +27,235 @@ from database import NewsDatabase
 
 logger = logging.getLogger(__name__)
 
-def genRSSFeed(rssitems):
+#What the feed is called when nothing else is said about it
+DEFAULT_TITLE = 'Steam Game News'
+DEFAULT_LINK = 'http://store.steampowered.com/news/?feed=mygames'
+DEFAULT_DESCRIPTION = 'All of your Steam games\' news, combined!'
+
+def genRSSFeed(rssitems, lbdate, feed: 'FeedDefinition' = None):
+    """Make the feed around rssitems, which can be any iterable
+    (items are only pulled from it as the XML gets written)"""
     pdate = datetime.now(timezone.utc)
-    lbdate = rssitems[0].pubDate
     return PyRSS2Gen.RSS2(
-        title='Steam Game News',
-        link='http://store.steampowered.com/news/?feed=mygames',
-        description='All of your Steam games\' news, combined!',
+        title=feed.title if feed else DEFAULT_TITLE,
+        link=feed.link if feed else DEFAULT_LINK,
+        description=feed.description if feed else DEFAULT_DESCRIPTION,
         pubDate=pdate,
         lastBuildDate=lbdate,
         items=rssitems
     )  # TODO should ttl get a value?
 
 
-def rowToRSSItem(row, db: NewsDatabase):
-    if row['feed_type'] == 1:
-        content = convertBBCodeToHTML(row['contents'])
+class FeedDefinition:
+    """One feed to publish: where it goes, what it's called,
+    and which of the recent news items go in it.
+    An item goes in if any of its games is in appids, its feedname is in feednames,
+    its feedlabel is in feedlabels and its feed_type is in feed_types
+    (a filter left as None lets everything through),
+    up to the newest max_items of them."""
+    def __init__(self, path, title=DEFAULT_TITLE, link=DEFAULT_LINK,
+            description=DEFAULT_DESCRIPTION, appids=None, feednames=None,
+            feedlabels=None, feed_types=None, max_items=None):
+        self.path = path
+        self.title = title
+        self.link = link
+        self.description = description
+        self.appids = set(appids) if appids is not None else None
+        self.feednames = set(feednames) if feednames is not None else None
+        self.feedlabels = set(feedlabels) if feedlabels is not None else None
+        self.feed_types = set(feed_types) if feed_types is not None else None
+        self.max_items = max_items
+
+    @classmethod
+    def from_dict(cls, d):
+        try:
+            return cls(**d)
+        except TypeError as e:
+            raise ValueError('Bad feed definition {!r}: {}'.format(d, e)) from e
+
+    def wants(self, row):
+        """Does a row from get_news_summary pass this feed's filters?"""
+        if self.feednames is not None and row['feedname'] not in self.feednames:
+            return False
+        if self.feedlabels is not None and row['feedlabel'] not in self.feedlabels:
+            return False
+        if self.feed_types is not None and row['feed_type'] not in self.feed_types:
+            return False
+        if self.appids is not None:
+            appids = row['appids'].split(',') if row['appids'] else ()
+            return any(int(appid) in self.appids for appid in appids)
+        return True
+
+    def select(self, summary):
+        """Pick this feed's items out of get_news_summary's rows.
+        Returns the set of their gids, a fingerprint of them (& of this definition),
+        and the newest one's date (None if there aren't any)."""
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps([self.title, self.link, self.description]).encode('utf-8'))
+        gids = set()
+        newest = None
+        for row in summary:
+            if self.max_items is not None and len(gids) >= self.max_items:
+                break
+            if not self.wants(row):
+                continue
+            gids.add(row['gid'])
+            h.update('{}|{}|{}\n'.format(row['gid'], row['date'], row['appids']).encode('utf-8'))
+            if newest is None or row['date'] > newest:
+                newest = row['date']
+        return gids, '{}:{}'.format(RENDERER_VERSION, h.hexdigest()), newest
+
+
+def load_feeds(path):
+    """Read feed definitions from a JSON file holding a list of objects,
+    each with FeedDefinition's arguments"""
+    with open(path) as f:
+        return [FeedDefinition.from_dict(d) for d in json.load(f)]
+
+
+def user_feeds(db, directory):
+    """A feed for each user, of the news from their enabled subscriptions,
+    published to directory/<their name>.xml.
+    Names that come out the same once made safe for a file name
+    (e.g. "a b" & "a_b") get -<userid> on the end instead."""
+    users = db.get_users()
+    safe = {user['userid']: ''.join(c if c.isalnum() or c in '-_.' else '_'
+            for c in user['name']) for user in users}
+    #lowercased, for case-insensitive file systems
+    clashes = Counter(name.lower() for name in safe.values())
+    feeds = []
+    taken = set()
+    for user in users:
+        filename = safe[user['userid']]
+        if clashes[filename.lower()] > 1:
+            filename += '-{}'.format(user['userid'])
+        while filename.lower() in taken: #someone's actually called that
+            filename += '-{}'.format(user['userid'])
+        taken.add(filename.lower())
+        appids = [aid for aid, on in db.get_subscriptions(user['userid']).items() if on]
+        feeds.append(FeedDefinition(os.path.join(directory, filename + '.xml'),
+                title="{}'s Steam Game News".format(user['name']), appids=appids))
+    return feeds
+
+
+class FeedWriter:
+    """Streams one feed's XML to a temp file, item by item,
+    and swaps it in for the real file once it's done,
+    so readers never see a partial feed.
+    In memory, the finished XML is left in `xml` (as bytes) instead."""
+    def __init__(self, feed: FeedDefinition, gids, lbdate, in_memory=False):
+        self.feed = feed
+        self.gids = gids
+        self.in_memory = in_memory
+        self.tmp_path = feed.path + '.tmp'
+        self.xml = None
+        #PyRSS2Gen only writes whole feeds, so write an empty one & split it
+        # around where the items go, to write them as they come instead
+        empty = genRSSFeed([], lbdate, feed).to_xml('utf-8')
+        split = empty.rindex('</channel>')
+        self.footer = empty[split:]
+        if in_memory:
+            self.file = io.StringIO()
+        else:
+            os.makedirs(os.path.dirname(feed.path) or '.', exist_ok=True)
+            self.file = open(self.tmp_path, 'w', encoding='utf-8')
+        self.file.write(empty[:split])
+
+    def write(self, item_xml):
+        self.file.write(item_xml)
+
+    def finish(self):
+        self.file.write(self.footer)
+        if self.in_memory:
+            self.xml = self.file.getvalue().encode('utf-8')
+        self.file.close()
+        if not self.in_memory:
+            os.replace(self.tmp_path, self.feed.path)
+
+    def abort(self):
+        self.file.close()
+        if not self.in_memory and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class PublishCache:
+    """Collects what gets rendered during a publish that wasn't cached in the DB yet
+    (see renderContents & decorateTitle), to be saved in one go afterwards.
+    Also times the rendering, in metrics."""
+    def __init__(self, metrics: RunMetrics = None):
+        self.html = []
+        self.titles = []
+        self.metrics = metrics or RunMetrics()
+
+    def save(self, db: NewsDatabase):
+        if self.html:
+            logger.info('Caching %d newly rendered items...', len(self.html))
+            db.save_rendered_html(self.html)
+        if self.titles:
+            logger.debug('Caching %d new titles...', len(self.titles))
+            db.save_titles(self.titles)
+
+
+#All the time spent rendering items, in RunMetrics phases
+RENDER_PHASES = ('bbcode render', 'title matching', 'parallel render')
+
+def renderChunk(rows):
+    """Process pool worker for renderInParallel: render rows (as plain dicts),
+    returning what got rendered as (cache.html, cache.titles)"""
+    cache = PublishCache()
+    for row in rows:
+        renderContents(row, cache)
+        decorateTitle(row, row['sources'].split(SOURCE_SEP) if row['sources'] else ['Unknown?'],
+                cache)
+    return cache.html, cache.titles
+
+
+def renderInParallel(rows, wanted, cache: PublishCache, workers):
+    """Render the rows with gids in wanted across `workers` processes,
+    for those that look like they aren't cached yet (the rest are cheap anyway).
+    Returns the wanted rows as dicts, still in order, with the new renderings filled in
+    as if they were cached; they're also noted in `cache` to be saved."""
+    rows = [dict(row) for row in rows if row['gid'] in wanted]
+    misses = [row for row in rows
+            if (row['feed_type'] == 1
+                and not isRenderingCached(row, contentHash(row['contents'] or '')))
+            or not isTitleCached(row)]
+    if not misses:
+        return rows
+    logger.info('Rendering %d items with %d processes...', len(misses), workers)
+    #a few chunks per worker evens out the load, but keeps the pickling overhead down
+    size = max(1, len(misses) // (workers * 4))
+    chunks = [misses[i:i + size] for i in range(0, len(misses), size)]
+    html = {}
+    titles = {}
+    with cache.metrics.phase('parallel render'), ProcessPoolExecutor(workers) as pool:
+        for rendered, decorated in pool.map(renderChunk, chunks):
+            cache.html.extend(rendered)
+            cache.titles.extend(decorated)
+            html.update((r[0], r) for r in rendered)
+            titles.update((t[0], t) for t in decorated)
+    for row in rows:
+        if row['gid'] in html:
+            _, row['content_hash'], row['renderer'], row['html'] = html[row['gid']]
+        if row['gid'] in titles:
+            _, row['title_sources'], row['rsstitle'] = titles[row['gid']]
+    return rows
+
+
+def rowToRSSItem(row, cache: PublishCache = None):
+    """Convert a row from get_news_rows to an RSSItem,
+    noting anything not already cached in `cache`."""
+    if cache is None:
+        cache = PublishCache()
+    with cache.metrics.phase('bbcode render'):
+        content = renderContents(row, cache)
+
+    if row['sources']:
+        games = row['sources'].split(SOURCE_SEP)
     else:
-        content = row['contents']
-
-    #Add the title of the game to the article title,
-    #  but only if not present according to 'in' or difflib.get_close_matches.
-    #get_close_matches isn't great for longer titles given the split() but /shrug
-    #There are other libraries for fuzzy matching but difflib is built in...
-    games = db.get_source_names_for_item(row['gid']) or ['Unknown?']
-    rsstitle = row['title']
-    if len(games) > 1:
-        rsstitle = '[Multiple] ' + rsstitle
-    elif (games[0] not in rsstitle and not
-            difflib.get_close_matches(games[0].lower(), rsstitle.lower().split(),
-                n=1, cutoff=0.8)):
-        rsstitle = '[{}] {}'.format(games[0], rsstitle)
-    #else game title is in article title, do nothing
+        games = ['Unknown?']
+    with cache.metrics.phase('title matching'):
+        rsstitle = decorateTitle(row, games, cache)
 
     source = row['feedlabel']
     if not source:
@@ -73,6 +279,92 @@ def rowToRSSItem(row, db: NewsDatabase):
     )  # omitted: categories, comments, enclosure, source
     return item
 
+# Bump this whenever a change to the BBCode conversion below should invalidate
+# the HTML already rendered & cached in the DB
+RENDERER_VERSION = 1
+
+def contentHash(contents):
+    return hashlib.blake2b(contents.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def isRenderingCached(row, digest):
+    """Is the row's cached HTML for contents with this contentHash
+    & the current RENDERER_VERSION?"""
+    return (row['html'] is not None and row['content_hash'] == digest
+            and row['renderer'] == RENDERER_VERSION)
+
+
+def isTitleCached(row):
+    """Is the row's cached title for the games it's from now?"""
+    return row['rsstitle'] is not None and row['title_sources'] == row['sources']
+
+
+def renderContents(row, cache: PublishCache):
+    """Get the HTML for a news row's contents, reusing the cached rendering
+    when it's for the same contents & RENDERER_VERSION.
+    Anything rendered fresh gets added to `cache.html` as
+    (gid, content_hash, renderer, html) so it can be saved for next time."""
+    if row['feed_type'] != 1:
+        return row['contents']
+    contents = row['contents'] or ''
+    digest = contentHash(contents)
+    if isRenderingCached(row, digest):
+        return row['html']
+    html = convertBBCodeToHTML(contents)
+    cache.html.append((row['gid'], digest, RENDERER_VERSION, html))
+    return html
+
+
+def decorateTitle(row, games, cache: PublishCache):
+    """Add the title of the game to the article title, unless it's already there.
+    The result only depends on the title & its games,
+    so it's cached in the DB (via `cache.titles`) along with the latter."""
+    if isTitleCached(row):
+        return row['rsstitle']
+    rsstitle = row['title']
+    if len(games) > 1:
+        rsstitle = '[Multiple] ' + rsstitle
+    elif not titleHasGame(games[0], rsstitle):
+        rsstitle = '[{}] {}'.format(games[0], rsstitle)
+    #else game title is in article title, do nothing
+    if row['sources'] is not None:
+        cache.titles.append((row['gid'], row['sources'], rsstitle))
+    return rsstitle
+
+
+#Title matching was difflib.get_close_matches(game, title.split(), cutoff=0.8)
+# i.e. is there any word in the title that's a close match for the game's name?
+#get_close_matches isn't great for longer titles given the split() but /shrug
+#There are other libraries for fuzzy matching but difflib is built in...
+#It re-analyzes the game name for each call though, so keep a matcher per name instead.
+TITLE_MATCH_CUTOFF = 0.8
+
+@lru_cache(maxsize=None)
+def gameNameMatcher(name):
+    """Get the lowercased name & a SequenceMatcher with it pre-analyzed"""
+    lower = name.lower()
+    matcher = difflib.SequenceMatcher()
+    matcher.set_seq2(lower)
+    return lower, matcher
+
+
+def titleHasGame(game, title):
+    """Does the title mention the game, either verbatim or as a close match?
+    Same result as the get_close_matches check above, minus the setup cost."""
+    if game in title:
+        return True
+    lower, matcher = gameNameMatcher(game)
+    for word in title.lower().split():
+        if word == lower:
+            return True
+        matcher.set_seq1(word)
+        #cheapest to most expensive upper bounds on ratio(), as get_close_matches does
+        if (matcher.real_quick_ratio() >= TITLE_MATCH_CUTOFF
+                and matcher.quick_ratio() >= TITLE_MATCH_CUTOFF
+                and matcher.ratio() >= TITLE_MATCH_CUTOFF):
+            return True
+    return False
+
 # RE: BBCode http://bbcode.readthedocs.org/
 # note: feed_type is 1 for steam community announcements
 #  (feedname usually == 'steam_community_announcements') and 0 otherwise
@@ -109,6 +401,12 @@ span.bb_spoiler:hover > span {
 
 
 def convertBBCodeToHTML(text):
+    return getBBCodeParser().format(text)
+
+
+@lru_cache(maxsize=None)
+def getBBCodeParser():
+    """Build the BBCode parser with Steam's extra tags, once"""
     bb = bbcode.Parser()
 
     for tag in ('strike', 'table', 'tr', 'th', 'td', 'h1', 'h2', 'h3'):
@@ -134,7 +432,7 @@ def convertBBCodeToHTML(text):
     bb.add_simple_formatter('spoiler',
             '<span style="color: #000000;background-color: #000000;padding: 0px 8px;">%(value)s</span>')  # see bbcode 's' & above css
 
-    return bb.format(text)
+    return bb
 
 # Community img tags frequently look like
 # [img]{STEAM_CLAN_IMAGE}/27357479/d1048c635a5672f8efea79138bfd105b3cae552e.jpg[/img]
@@ -189,17 +487,94 @@ def render_dynlink(tag_name, value, options, parent, context):
     except (KeyError, ValueError):
         return ''
 
-def publish(db: NewsDatabase, output_path=None):
-    if not output_path:
-        output_path = 'steam_news.xml'
-    logger.info('Generating RSS feed...')
-    row_func = partial(rowToRSSItem, db=db)
-    rssitems = list(map(row_func, db.get_news_rows()))
-    feed = genRSSFeed(rssitems)
-    logger.info('Writing to %s...', output_path)
-    with open(output_path, 'w') as f:
-        feed.write_xml(f, 'utf-8')
+def itemToXML(item: PyRSS2Gen.RSSItem):
+    """Serialize an item once, to be written into however many feeds it's in"""
+    out = io.StringIO()
+    item.publish(saxutils.XMLGenerator(out, 'utf-8'))
+    return out.getvalue()
+
+
+def publish(db: NewsDatabase, output_path=None, force=False, metrics: RunMetrics = None,
+        workers=None):
+    """Write the RSS feed of all recent news to output_path, unless nothing that goes
+    into it changed since the last time it was published there (or force is set).
+    Timings go into metrics, if given. Returns whether the feed was written."""
+    feed = FeedDefinition(output_path or 'steam_news.xml')
+    return publish_feeds(db, [feed], force, metrics, workers=workers) == 1
+
+
+def publish_feeds(db: NewsDatabase, feeds, force=False, metrics: RunMetrics = None,
+        in_memory: dict = None, workers=None):
+    """Write each of the FeedDefinitions in feeds, all in one pass over the news,
+    rendering each item only once however many feeds it's in.
+    Feeds with nothing changed since they were last published are skipped
+    (unless force is set). Returns how many feeds were written.
+    If in_memory is given, feeds go in it as {path: (fingerprint, xml bytes)}
+    instead of being written to disk, and are compared to what's already there.
+    With workers > 1, items not rendered before are rendered by that many processes."""
+    metrics = metrics or RunMetrics()
+    pending = []
+    with metrics.phase('publish check'):
+        summary = db.get_news_summary().fetchall()
+        for feed in feeds:
+            gids, fingerprint, newest = feed.select(summary)
+            if in_memory is not None:
+                unchanged = in_memory.get(feed.path, (None,))[0] == fingerprint
+            else:
+                unchanged = (os.path.exists(feed.path) and fingerprint ==
+                        db.get_publish_fingerprint(os.path.abspath(feed.path)))
+            if not force and unchanged:
+                logger.info('No changes to publish to %s.', feed.path)
+                metrics.count('feeds unchanged')
+                continue
+            pending.append((feed, gids, fingerprint, newest))
+    if not pending:
+        return 0
+
+    logger.info('Generating RSS feeds to %s...', ', '.join(p[0].path for p in pending))
+    cache = PublishCache(metrics)
+    writers = []
+    wanted = set()
+    #Items are rendered as they're written, so take that back out of the writing time
+    rendering = sum(metrics.phases.get(phase, 0) for phase in RENDER_PHASES)
+    start = time.perf_counter()
+    try:
+        for feed, gids, _, newest in pending:
+            lbdate = datetime.fromtimestamp(newest, timezone.utc) if newest else None
+            writers.append(FeedWriter(feed, gids, lbdate, in_memory is not None))
+            wanted |= gids
+        rows = db.get_news_rows() if wanted else ()
+        if wanted and workers and workers > 1:
+            rows = renderInParallel(rows, wanted, cache, workers)
+        for row in rows:
+            if row['gid'] not in wanted:
+                continue
+            item_xml = itemToXML(rowToRSSItem(row, cache))
+            for writer in writers:
+                if row['gid'] in writer.gids:
+                    writer.write(item_xml)
+            wanted.discard(row['gid'])
+            if not wanted: #every feed has all its items
+                break
+        for writer in writers:
+            writer.finish()
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    rendering = sum(metrics.phases.get(phase, 0) for phase in RENDER_PHASES) - rendering
+    metrics.add_time('xml write', time.perf_counter() - start - rendering)
+
+    with metrics.phase('db write'):
+        cache.save(db)
+        for writer, (feed, _, fingerprint, _) in zip(writers, pending):
+            if in_memory is not None:
+                in_memory[feed.path] = (fingerprint, writer.xml)
+            else:
+                db.set_publish_fingerprint(os.path.abspath(feed.path), fingerprint)
+    metrics.count('feeds published', len(pending))
     logger.info('Published!')
+    return len(pending)
 
 if __name__ == '__main__':
     import sys
@@ -5,21 +5,33 @@
 # http://www.getoffmalawn.com/blog/rss-feeds-for-steam-games
 
 import argparse
-from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+import hashlib
+import http.client
 import json
 import logging
-import subprocess
 import sys
+import threading
 import time
-from urllib.request import urlopen
-from urllib.error import HTTPError
-import xml.dom.minidom  # Maybe replace this one...
+from urllib.parse import urlsplit
 
 from database import NewsDatabase
-from NewsPublisher import publish
+from metrics import RunMetrics
+#Anything only some subcommands need (publishing, serving, profiles, whiptail)
+# is imported where it's used, so cron runs of `fetch` start quickly;
+# see benchmarks/check_import_time.py
 
 logger = logging.getLogger(__name__)
 
+API_BASE = 'https://api.steampowered.com'
+PROFILE_BASE = 'https://steamcommunity.com'
+NEWS_PATH = '/ISteamNews/GetNewsForApp/v0002/?format=json&maxlength=0&count={count}&appid={appid}'
+#How many items to ask for; when fetching incrementally, apps we already have news for
+# get asked for fewer, & only get asked for the full count again if those were all new
+FULL_COUNT = 10
+INCREMENTAL_COUNT = 3
+
 # Hardcoded list of AppIDs that return news related to Steam as a whole (not games)
 # Mileage may vary. Use app_id_discovery.py to maybe find more of these...
 STEAM_APPIDS = {753: 'Steam',
@@ -35,37 +47,64 @@ STEAM_APPIDS = {753: 'Steam',
         613220: 'Steam 360 Video Player'}
 
 
-def seed_database(idOrVanity, db: NewsDatabase):
+def profileGamesURL(idOrVanity):
     try:
         sid = int(idOrVanity)
-        url = 'https://steamcommunity.com/profiles/{}/games?xml=1'.format(sid)
+        return '{}/profiles/{}/games?xml=1'.format(PROFILE_BASE, sid)
     except ValueError:  # it's probably a vanity str
-        url = 'https://steamcommunity.com/id/{}/games?xml=1'.format(idOrVanity)
+        return '{}/id/{}/games?xml=1'.format(PROFILE_BASE, idOrVanity)
+
+
+def _add_games(db: NewsDatabase, games, userid=None):
+    """add_games, or subscribe the user to them if there is one"""
+    if userid is None:
+        db.add_games(games)
+    else:
+        db.subscribe(userid, games)
+
 
-    newsids = getAppIDsFromURL(url)
+def seed_database(idOrVanity, db: NewsDatabase, userid=None):
+    """Add the profile's games, subscribing the user (a userid) to them if given"""
+    _add_games(db, getAppIDsFromURL(profileGamesURL(idOrVanity)), userid)
     #Also add the hardcoded ones...
-    newsids.update(STEAM_APPIDS)
-    db.add_games(newsids)
+    _add_games(db, STEAM_APPIDS, userid)
+
+
+def seed_database_from_profiles(profiles, db: NewsDatabase, workers=4, userid=None):
+    """seed_database for several profiles, downloading their game lists concurrently"""
+    if len(profiles) == 1:
+        return seed_database(profiles[0], db, userid)
+
+    def download(idOrVanity):
+        return list(getAppIDsFromURL(profileGamesURL(idOrVanity)))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(download, p): p for p in profiles}
+        for fut in as_completed(pending):
+            logger.info('Adding games from %s...', pending[fut])
+            _add_games(db, fut.result(), userid)
+    _add_games(db, STEAM_APPIDS, userid)
 
 
 def getAppIDsFromURL(url):
-    """Given a steam profile url, produce a dict of
-    appids to names of games owned (appids are strings)
+    """Given a steam profile url, generate (appid, name) pairs
+    of games owned (appids are ints) as they're read,
     i.e. parses unofficial XML API of a Steam user's game list.
     Note that the profile in question needs to be public for this to work!"""
+    from urllib.request import urlopen
+    from xml.etree import ElementTree
     logger.info('Parsing XML from %s...', url)
-    xmlstr = urlopen(url).read().decode('utf-8')
-    dom = xml.dom.minidom.parseString(xmlstr)
-    gameEls = dom.getElementsByTagName('game')
-
-    games = {}
-    for ge in gameEls:
-        appid = int(ge.getElementsByTagName('appID')[0].firstChild.data)
-        name = ge.getElementsByTagName('name')[0].firstChild.data
-        games[appid] = name
-
-    logger.info('Found %d games.', len(games))
-    return games
+    count = 0
+    with urlopen(url) as response:
+        #Stream it instead of building the whole DOM;
+        # each <game> is thrown away once we have what we need from it
+        for _event, elem in ElementTree.iterparse(response):
+            if elem.tag == 'game':
+                yield int(elem.findtext('appID')), elem.findtext('name')
+                count += 1
+                elem.clear()
+
+    logger.info('Found %d games.', count)
 
 # Date/time manipulation
 
@@ -88,80 +127,448 @@ def parseExpiresAsDT(exp):
 # I shorthanded "news element dict" to distinguish it as a single item
 # vs. 'news' which is typically used for the entire JSON payload Steam gives us
 
-def getNewsForAppID(appid):
-    """Get news for the given appid as a dict"""
-    url = 'https://api.steampowered.com/ISteamNews/GetNewsForApp/v0002/?format=json&maxlength=0&count=10&appid={}'.format(appid)
+class ConnectionPool:
+    """Keep-alive connections to the Steam API, one per thread,
+    so a fetch run only pays for the TCP/TLS handshake once per worker."""
+    def __init__(self, base=None, timeout=30):
+        parts = urlsplit(base or API_BASE)
+        if parts.scheme == 'https':
+            self.conn_class = http.client.HTTPSConnection
+        else:
+            self.conn_class = http.client.HTTPConnection
+        self.netloc = parts.netloc
+        self.timeout = timeout
+        self.local = threading.local()
+        self.conns = []
+        self.lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.conn_class(self.netloc, timeout=self.timeout)
+            self.local.conn = conn
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+
+    def get(self, path, headers=None):
+        """GET path, returning the (fully read) response & its body.
+        Retries once if the server dropped our idle connection."""
+        for attempt in (1, 2):
+            conn = self._connection()
+            try:
+                conn.request('GET', path, headers=headers or {})
+                response = conn.getresponse()
+                body = response.read()
+                if response.will_close:
+                    conn.close()
+                return response, body
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def responseHash(body: bytes):
+    """A cheap fingerprint of a news response, to tell if it's the same as last time's"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def getNewsForAppID(appid, pool: ConnectionPool = None, validators=None, count=FULL_COUNT,
+        body_hash=None):
+    """Get the newest `count` news items for the given appid as a dict.
+    validators is an optional (etag, last_modified) pair from the last fetch;
+    if Steam says nothing changed, the dict has 'notmodified' instead of 'appnews'.
+    body_hash is the last response's responseHash; a response that matches it
+    counts as not modified too (with 'samebody'), without decoding it at all.
+    A successful response's hash is in the dict's 'body_hash'."""
+    headers = {}
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    if pool is None:
+        with ConnectionPool() as pool:
+            return getNewsForAppID(appid, pool, validators, count, body_hash)
+    #How the request went, for metrics.RunMetrics.record_fetch
+    stats = {'status': None, 'bytes': 0, 'http': 0, 'decode': 0}
+    start = time.perf_counter()
     try:
-        response = urlopen(url)
-        # Get value of 'expires' header as a datetime obj
-        exdt = getExpiresDTFromResponse(response)
-        # Parse the JSON
-        news = json.loads(response.read().decode('utf-8'))
-        # Add the expire time to the group as a plain unix time
-        news['expires'] = int(exdt.timestamp())
-        # Decorate each news item and the group with its "true" appid
-        for ned in news['appnews']['newsitems']:
-            ned['realappid'] = appid
-
-        return news
-    except HTTPError as e:
-        return {'error': '{} {}'.format(e.code, e.reason)}
-
-
-def isNewsOld(ned):
-    """Is this news item more than 30 days old?"""
-    newsdt = datetime.fromtimestamp(ned['date'], timezone.utc)
-    thirtyago = datetime.now(timezone.utc) - timedelta(days=30)
-    return newsdt < thirtyago
+        response, body = pool.get(NEWS_PATH.format(count=count, appid=appid), headers)
+    except OSError as e: #includes socket timeouts
+        return {'error': str(e), 'stats': stats}
+    except http.client.HTTPException as e:
+        return {'error': repr(e), 'stats': stats}
+    finally:
+        stats['http'] = time.perf_counter() - start
+    stats['status'] = response.status
+    stats['bytes'] = len(body)
+
+    if response.status == 304:
+        news = {'notmodified': True}
+    elif response.status == 200 and body_hash and responseHash(body) == body_hash:
+        #Steam often doesn't do conditional requests, but sends the same thing anyway
+        news = {'notmodified': True, 'samebody': True}
+    elif response.status == 200:
+        start = time.perf_counter()
+        try:
+            # Parse the JSON
+            news = json.loads(body.decode('utf-8'))
+            # Decorate each news item and the group with its "true" appid
+            for ned in news['appnews']['newsitems']:
+                ned['realappid'] = appid
+        except (ValueError, KeyError, TypeError) as e:
+            #a garbled or unexpected body is this app's failure, like an error status
+            return {'error': 'Bad response: {!r}'.format(e), 'stats': stats}
+        finally:
+            stats['decode'] = time.perf_counter() - start
+        news['body_hash'] = responseHash(body)
+    else:
+        error = {'error': '{} {}'.format(response.status, response.reason), 'stats': stats}
+        retry_after = response.getheader('Retry-After')
+        if retry_after and retry_after.isdigit():
+            error['retry_after'] = int(retry_after)
+        return error
+
+    # Get value of 'expires' header as a datetime obj
+    exdt = getExpiresDTFromResponse(response)
+    # Add the expire time to the group as a plain unix time
+    news['expires'] = int(exdt.timestamp())
+    # Keep the validators around for next time's conditional request
+    news['etag'] = response.getheader('ETag')
+    news['last_modified'] = response.getheader('Last-Modified')
+    news['stats'] = stats
+    return news
+
+
+#News older than this many days isn't "recent"; it's neither stored nor published
+RECENT_DAYS = 30
+
+def recentCutoff(now=None):
+    """The unix time before which news isn't recent"""
+    return int(now if now is not None else time.time()) - RECENT_DAYS * 86400
+
+
+def isNewsOld(ned, cutoff=None):
+    """Is this news item more than 30 days old (i.e. from before cutoff)?"""
+    return ned['date'] < (cutoff if cutoff is not None else recentCutoff())
+
+
+class KnownNews:
+    """The recent news items already in the DB & the apps they're from,
+    loaded once per fetch run so items we have already don't need a trip to SQLite.
+    Kept up to date with what saveRecentNews adds during the run."""
+    def __init__(self, db: NewsDatabase, cutoff=None):
+        self.cutoff = cutoff if cutoff is not None else recentCutoff()
+        self.gids = set()
+        self.sources = set()
+        for gid, appid in db.get_recent_sources(self.cutoff):
+            self.gids.add(gid)
+            if appid is not None:
+                self.sources.add((gid, appid))
+        self.new_items = 0
+        self.new_sources = 0
+
+    def save(self, ned: dict, db: NewsDatabase):
+        """Write a news item to db, or just its source if the item's known,
+        or nothing if both are"""
+        source = (ned['gid'], ned['realappid'])
+        if source in self.sources:
+            return
+        if ned['gid'] in self.gids:
+            #cross-posted from another app we already have it for
+            db.insert_news_source(*source)
+            self.new_sources += 1
+        else:
+            db.insert_news_item(ned)
+            self.gids.add(ned['gid'])
+            self.new_items += 1
+        self.sources.add(source)
 
 
-def saveRecentNews(news: dict, db: NewsDatabase):
+def saveRecentNews(news: dict, db: NewsDatabase, known_date=None, known: KnownNews = None):
     """Given a single news dict from getNewsForAppID,
-    save all "recent" news items to the DB"""
-    db.update_expire_time(news['appnews']['appid'], news['expires'])
-
+    save all "recent" news items to the DB (or a batch of writes to it).
+    Items older than known_date (the newest one we already have, if given)
+    are skipped; we'd have gotten them back when they were the newest.
+    With `known`, only items (or sources for items) not already in it get written."""
+    db.update_expire_time(news['appnews']['appid'], news['expires'],
+            news['etag'], news['last_modified'], news.get('body_hash'))
+
+    cutoff = known.cutoff if known else recentCutoff()
     current_entries = 0
     for ned in news['appnews']['newsitems']:
-        if not isNewsOld(ned):
+        if known_date is not None and ned['date'] < known_date:
+            continue
+        if isNewsOld(ned, cutoff):
+            continue
+        current_entries += 1
+        if known:
+            known.save(ned, db)
+        else:
             db.insert_news_item(ned)
-            current_entries += 1
     return current_entries
 
 
-def getAllRecentNews(newsids: dict, db: NewsDatabase):
-    """Given a dict of appids to names, store all "recent" items, respecting the cache"""
+class RateLimiter:
+    """Token bucket shared between fetch workers.
+    Refills at `rate` tokens per second, holding at most `burst` of them."""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Block until a request is allowed to go out."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self, seconds: float):
+        """Drain the bucket so that nobody sends anything for about `seconds`"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    def slow_down(self, factor: float = 0.5, floor: float = 0.2):
+        """Cut the rate for the rest of the run (to no less than `floor` per second)"""
+        with self.lock:
+            self._refill()
+            self.rate = max(floor, self.rate * factor)
+        return self.rate
+
+
+# Failing apps are retried less & less often; FAILURE_BACKOFF after the first failure,
+# doubling each time up to MAX_BACKOFF.
+# Apps that keep getting told no (e.g. 403 Forbidden, 404 Not Found) are parked instead
+# after PARK_AFTER failures in a row: only tried once every PARK_SECONDS, until one works
+FAILURE_BACKOFF = 15 * 60
+MAX_BACKOFF = 24 * 3600
+PARK_AFTER = 5
+PARK_SECONDS = 30 * 86400
+#These mean Steam wants fewer requests, not that the app is broken
+THROTTLE_STATUSES = {429, 503}
+
+def failureRetryTime(failures, status, now):
+    """When to try an app again after its `failures`th failure in a row,
+    the latest with HTTP status (None if there was no response),
+    and whether it's being parked"""
+    refused = status is not None and 400 <= status < 500 and status not in (408, 429)
+    if refused and failures >= PARK_AFTER:
+        return now + PARK_SECONDS, True
+    return now + min(MAX_BACKOFF, FAILURE_BACKOFF * 2 ** (failures - 1)), False
+
+
+# Adaptive polling: most games go quiet for months or years at a time,
+# so polling them as often as Steam's Expires header allows is mostly wasted.
+QUIET_FACTOR = 8 # poll a quiet game ~this many times over its quiet period so far
+
+def adaptivePollInterval(quiet, min_interval, max_interval):
+    """How many seconds to wait before polling a game that hasn't posted for `quiet` seconds
+    (None if it never has); doubles from min_interval as the quiet period doubles."""
+    if quiet is None:
+        return max_interval
+    interval = min_interval
+    while interval < max_interval and quiet >= interval * QUIET_FACTOR * 2:
+        interval *= 2
+    return min(interval, max_interval)
+
+
+def getAllRecentNews(db: NewsDatabase, workers=1, rate=4.0, commit_every=50, max_apps=None,
+        adaptive=None, incremental=False, metrics: RunMetrics = None):
+    """Store all "recent" items for the games that are due to be fetched,
+    most overdue first, optionally stopping after `max_apps` of them.
+    Up to `workers` requests run at once, limited to `rate` requests per second;
+    everything touching the DB stays on the calling thread,
+    and is committed once per `commit_every` fetched apps.
+    If adaptive is a (min, max) pair of seconds, games that haven't posted in a while
+    aren't fetched again until adaptivePollInterval says so (or Expires, if later).
+    If incremental, games we already have news for are only asked for
+    INCREMENTAL_COUNT items (FULL_COUNT if those were all new),
+    and items older than what we have are skipped.
+    Timings & counts go into metrics, if given."""
+    metrics = metrics or RunMetrics()
     total_current = 0
-    cachehits = 0
     newhits = 0
+    unchanged = 0
+    samebody = 0
     fails = 0
-    for aid, name in newsids.items():
-        if db.is_news_cached(aid):
-            logger.info('Cache for %d: %s still valid!', aid, name)
-            cachehits += 1
-        else:
-            news = getNewsForAppID(aid)
-            if 'appnews' in news: # success
-                cur_entries = saveRecentNews(news, db)
-                newhits += 1
-                if cur_entries:
-                    logger.info('Fetched %d: %s OK; %d current items', aid, name, cur_entries)
-                    total_current += cur_entries
-                else:
-                    logger.info('Fetched %d: %s OK; nothing current', aid, name)
-                time.sleep(0.25)
-            else:
-                fails += 1
-                logger.error('%d: %s fetch error: %s', aid, name, news['error'])
-                time.sleep(1)
-
-    logger.info('Run complete. %d cached, %d fetched, %d failed; %d current news items',
-            cachehits, newhits, fails, total_current)
+    parked = 0
+    throttled = 0
+    widened = 0
+    limiter = RateLimiter(rate)
+    now = int(time.time())
+    with metrics.phase('cache check'):
+        due = db.get_due_games(now, max_apps)
+        cachehits = db.count_cached_games(now)
+        known = KnownNews(db, recentCutoff(now)) if due else None
+    logger.info('%d games due for fetching, %d still cached.', len(due), cachehits)
+
+    #set if the run's being cut short, so queued fetches don't go ahead anyway
+    stop = threading.Event()
+
+    def fetch(game):
+        known = game['last_post'] if incremental else None
+        count = INCREMENTAL_COUNT if known is not None else FULL_COUNT
+        limiter.acquire()
+        if stop.is_set():
+            return None
+        news = getNewsForAppID(game['appid'], pool,
+                (game['etag'], game['last_modified']), count, game['body_hash'])
+        status = news['stats']['status']
+        if status in THROTTLE_STATUSES:
+            #slow the whole run down, & wait as long as we're told to (if we're told)
+            rate = limiter.slow_down()
+            limiter.penalize(news.get('retry_after', 5))
+            logger.warning('Got %s; slowing down to %.2f requests/second', news['error'], rate)
+        elif 'error' in news and (status is None or status >= 500):
+            #no answer or a server error; back off a bit for everyone
+            limiter.penalize(1)
+        elif 'appnews' in news and count < FULL_COUNT:
+            items = news['appnews']['newsitems']
+            if len(items) >= count and all(ned['date'] > known for ned in items):
+                #all new, so there may be more we haven't seen; ask for the lot.
+                # The validators, hash & expiry stay the narrow request's,
+                # since that's the one we'll make again next time
+                limiter.acquire()
+                if stop.is_set():
+                    return news
+                wider = getNewsForAppID(game['appid'], pool, None, FULL_COUNT)
+                for stat in ('bytes', 'http', 'decode'):
+                    news['stats'][stat] += wider['stats'][stat]
+                if 'appnews' in wider:
+                    news['appnews'] = wider['appnews']
+                    news['widened'] = True
+        return news
 
-def edit_fetch_games(name, db: NewsDatabase):
+    def next_fetch_time(game, news):
+        if not adaptive:
+            return news['expires']
+        dates = [ned['date'] for ned in news.get('appnews', {}).get('newsitems', ())]
+        if game['last_post'] is not None:
+            dates.append(game['last_post'])
+        quiet = now - max(dates) if dates else None
+        return max(news['expires'], now + adaptivePollInterval(quiet, *adaptive))
+
+    with ConnectionPool() as pool, ThreadPoolExecutor(max_workers=workers) as executor, \
+            db.batch(commit_every) as batch:
+        pending = {executor.submit(fetch, game): game for game in due}
+        try:
+            for fut in as_completed(pending):
+                game = pending[fut]
+                aid, name = game['appid'], game['name']
+                news = fut.result()
+                metrics.record_fetch(aid, news['stats'])
+                if 'error' not in news:
+                    news['expires'] = next_fetch_time(game, news)
+                if 'appnews' in news: # success
+                    with metrics.phase('db write'):
+                        cur_entries = saveRecentNews(news, batch,
+                                game['last_post'] if incremental else None, known)
+                    newhits += 1
+                    widened += news.get('widened', False)
+                    if cur_entries:
+                        logger.info('Fetched %d: %s OK; %d current items', aid, name, cur_entries)
+                        total_current += cur_entries
+                    else:
+                        logger.info('Fetched %d: %s OK; nothing current', aid, name)
+                elif 'notmodified' in news:
+                    with metrics.phase('db write'):
+                        batch.update_expire_time(aid, news['expires'],
+                                news['etag'], news['last_modified'])
+                    unchanged += 1
+                    samebody += news.get('samebody', False)
+                    logger.info('Fetched %d: %s OK; not modified', aid, name)
+                else:
+                    fails += 1
+                    logger.error('%d: %s fetch error: %s', aid, name, news['error'])
+                    status = news['stats']['status']
+                    if status in THROTTLE_STATUSES:
+                        #not the app's fault; it's still due next run
+                        throttled += 1
+                        continue
+                    failures = game['failures'] + 1
+                    retry_at, park = failureRetryTime(failures, status, now)
+                    if park:
+                        parked += 1
+                        logger.warning('Parking %d: %s after %d failures in a row; next try %s',
+                                aid, name, failures,
+                                datetime.fromtimestamp(retry_at).strftime('%Y-%m-%d %H:%M'))
+                    with metrics.phase('db write'):
+                        batch.record_failure(aid, failures, status, news['error'], now,
+                                retry_at, park)
+        except BaseException:
+            #e.g. Ctrl+C or SIGTERM; don't let everything still queued go out
+            # while the executor shuts down, & keep what we've already got
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            logger.warning('Fetching stopped early; saving what was fetched so far...')
+            with metrics.phase('db write'):
+                batch.flush()
+            raise
+
+        #whatever's still buffered gets written as the batch closes
+        with metrics.phase('db write'):
+            batch.flush()
+
+    for counter, n in (('apps cached', cachehits), ('apps fetched', newhits),
+            ('apps unchanged', unchanged), ('same responses', samebody),
+            ('apps failed', fails),
+            ('apps parked', parked), ('apps throttled', throttled),
+            ('fetches widened', widened),
+            ('current news items', total_current),
+            ('news items added', known.new_items if known else 0),
+            ('news sources added', known.new_sources if known else 0)):
+        metrics.count(counter, n)
+    logger.info('Run complete. %d cached, %d fetched, %d unchanged, %d failed; %d current news items',
+            cachehits, newhits, unchanged, fails, total_current)
+
+def print_fetch_failures(db: NewsDatabase):
+    """List the games that keep failing to fetch, parked ones first"""
+    print('appid|name|failures|last error|next try|parked')
+    for row in db.get_fetch_failures():
+        print('{}|{}|{}|{}|{}|{}'.format(row['appid'], row['name'], row['failures'],
+                row['last_error'],
+                datetime.fromtimestamp(row['retry_at']).strftime('%Y-%m-%d %H:%M'),
+                'yes' if row['parked'] else 'no'))
+
+def edit_fetch_games(name, db: NewsDatabase, catalogue=None, userid=None):
+    """Pick which games like name to fetch news for.
+    With a catalogue (an appids.db), games not in the DB yet can be picked too.
+    With a userid, pick which games are in that user's feed instead."""
+    import subprocess
     logger.info('Editing games like "%s"', name)
-    games = db.get_games_like(name)
+    games = db.get_games_like(name, catalogue, userid=userid)
     before_on = set()
     before_off = set()
+    unowned = {}
     args = ['whiptail', '--title', 'Select games to fetch news for',
             '--separate-output', '--checklist',
             'Use arrow keys to move, Space to toggle, Tab to go to OK, ESC to cancel.',
@@ -173,6 +580,8 @@ def edit_fetch_games(name, db: NewsDatabase):
         else:
             before_off.add(game['appid'])
             status = 'off'
+        if not game['owned']:
+            unowned[game['appid']] = game['name']
         args.append(str(game['appid']))
         args.append(game['name'])
         args.append(status)
@@ -196,44 +605,369 @@ def edit_fetch_games(name, db: NewsDatabase):
     logger.debug('Enabled %s\nDisabled: %s', enabled, disabled)
 
     if disabled:
-        db.disable_fetching_ids(disabled)
+        if userid is None:
+            db.disable_fetching_ids(disabled)
+        else:
+            db.set_subscriptions_enabled(userid, disabled, False)
         logger.info('Disabled %d games.', len(disabled))
+    added = {aid: unowned[aid] for aid in enabled if aid in unowned}
+    if added:
+        db.add_games(added)
     if enabled:
-        db.enable_fetching_ids(enabled)
+        if userid is None:
+            db.enable_fetching_ids(enabled)
+        else:
+            db.set_subscriptions_enabled(userid, enabled)
         logger.info('Enabled %d games.', len(enabled))
 
-def main():
+def print_users(db: NewsDatabase):
+    """Print name|subscribed games|enabled games for each user"""
+    for row in db.get_users():
+        print('{}|{}|{}'.format(row['name'], row['games'], row['enabled']))
+
+def print_run_history(db: NewsDatabase, limit=20):
+    """List the latest runs from RunHistory, newest first, to spot regressions"""
+    print('started|seconds|fetched|unchanged|failed|items added|median http|p95 http')
+    for run in db.get_run_history(limit):
+        counts = run['counts']
+        latency = run['fetch_latency']
+        print('{}|{}|{}|{}|{}|{}|{}|{}'.format(
+                datetime.fromtimestamp(run['started']).strftime('%Y-%m-%d %H:%M:%S'),
+                run['seconds'], counts.get('apps fetched', 0), counts.get('apps unchanged', 0),
+                counts.get('apps failed', 0), counts.get('news items added', 0),
+                latency['median'], latency['p95']))
+
+def print_slow_apps(db: NewsDatabase, limit=20):
+    """List the apps that most often were among the slowest fetches
+    (metrics.SLOWEST_FETCHES per run) over the latest `limit` runs"""
+    slow = {}
+    for run in db.get_run_history(limit):
+        for fetch in run['slowest_fetches']:
+            times = slow.setdefault(fetch['appid'], [])
+            times.append(fetch.get('http', 0))
+    names = db.get_fetch_games()
+    print('appid|name|slowest in runs|worst http|median http')
+    for appid, times in sorted(slow.items(), key=lambda a: (-len(a[1]), -max(a[1]))):
+        times.sort()
+        print('{}|{}|{}|{}|{}'.format(appid, names.get(appid, ''), len(times),
+                times[-1], times[len(times) // 2]))
+
+#Don't check for due games more often than this while serving
+MIN_SERVE_WAIT = 60
+
+def serve_feeds(db: NewsDatabase, feeds, host='127.0.0.1', port=8080, poll=900,
+        fetch_args: dict = None, keep=(None, None), report=None, prom=None, render_workers=None,
+        user_feeds_dir=None):
+    """Keep fetching news as games come due & republishing feeds, serving them
+    over HTTP from memory, until interrupted.
+    The DB stays open (and is only used) on this thread; between runs,
+    it sleeps until the next game is due, but checks at least every `poll` seconds.
+    fetch_args go to getAllRecentNews; keep is (max_age_days, max_items) to prune to;
+    render_workers is how many processes publish_feeds renders with;
+    with user_feeds_dir, every user's feed is served too (as for user_feeds)."""
+    from NewsPublisher import publish_feeds, user_feeds
+    from feed_server import FeedServer, feedURLPath
+    #feeds are served by file name, so two with the same one would replace each other
+    urls = {}
+    for feed in feeds:
+        url = feedURLPath(feed.path)
+        if url in urls:
+            raise ValueError('{} & {} would both be served at {}'.format(
+                    urls[url], feed.path, url))
+        urls[url] = feed.path
+
+    def served_user_feeds():
+        served = []
+        for feed in user_feeds(db, user_feeds_dir):
+            url = feedURLPath(feed.path)
+            if url in urls:
+                logger.error('Not serving %s; %s is already %s', feed.path, url, urls[url])
+            else:
+                served.append(feed)
+        return served
+
+    published = {}
+    with FeedServer(host, port) as server:
+        for feed in feeds:
+            logger.info('Feed %s will be at %s', feed.path, feedURLPath(feed.path))
+        while True:
+            wait = poll
+            try:
+                #users & their subscriptions can change while we're running
+                run_feeds = feeds + (served_user_feeds() if user_feeds_dir else [])
+                metrics = RunMetrics()
+                getAllRecentNews(db, metrics=metrics, **(fetch_args or {}))
+                if keep != (None, None):
+                    db.prune_news(*keep)
+                db.incremental_vacuum()
+                if publish_feeds(db, run_feeds, metrics=metrics, in_memory=published,
+                        workers=render_workers):
+                    server.update(published)
+
+                run = metrics.report()
+                db.add_run_history(run)
+                if report:
+                    metrics.write_json(report, run)
+                if prom:
+                    metrics.write_prometheus(prom, run)
+
+                next_due = db.get_next_due_time()
+                if next_due is not None:
+                    wait = min(poll, max(MIN_SERVE_WAIT, next_due - time.time()))
+            except Exception:
+                #one bad run shouldn't take the feeds down; keep serving the last ones
+                logger.exception('Fetching & publishing failed; trying again later')
+            logger.info('Next check in %d seconds.', wait)
+            time.sleep(wait)
+
+
+# Subcommands; each gets the open DB & its parsed arguments
+
+def collect_feeds(db: NewsDatabase, args, serving=False):
+    """The feeds asked for with -p, --feeds & --user-feeds.
+    When serving, user feeds are left to serve_feeds, which keeps them up to date."""
+    want_users = args.user_feeds and not serving
+    if not (args.publish or args.feeds or want_users):
+        return []
+    from NewsPublisher import load_feeds, user_feeds, FeedDefinition
+    feeds = load_feeds(args.feeds) if args.feeds else []
+    if args.publish:
+        feeds.append(FeedDefinition(args.publish))
+    if want_users:
+        feeds.extend(user_feeds(db, args.user_feeds))
+    return feeds
+
+def publish_collected(db: NewsDatabase, args, metrics: RunMetrics):
+    feeds = collect_feeds(db, args)
+    if feeds:
+        from NewsPublisher import publish_feeds
+        publish_feeds(db, feeds, force=args.force_publish, metrics=metrics,
+                workers=args.render_workers)
+
+def record_run(db: NewsDatabase, args, metrics: RunMetrics):
+    report = metrics.report()
+    db.add_run_history(report)
+    if args.report:
+        metrics.write_json(args.report, report)
+    if args.prom:
+        metrics.write_prometheus(args.prom, report)
+
+def fetch_args(args):
+    """getAllRecentNews' keyword arguments from the fetch options"""
+    adaptive = None
+    if args.adaptive:
+        adaptive = (int(args.min_interval * 3600), int(args.max_interval * 3600))
+    return {'workers': args.fetch_workers, 'rate': args.fetch_rate,
+            'commit_every': args.commit_every, 'max_apps': args.max_fetch,
+            'adaptive': adaptive, 'incremental': args.incremental}
+
+def cmd_init(db: NewsDatabase, args):
+    db.first_run()
+    if args.profiles:
+        cmd_add(db, args)
+
+def cmd_add(db: NewsDatabase, args):
+    userid = db.add_user(args.user) if args.user else None
+    seed_database_from_profiles(args.profiles, db, userid=userid)
+
+def cmd_edit(db: NewsDatabase, args):
+    userid = None
+    if args.user:
+        userid = db.get_user(args.user)
+        if userid is None:
+            sys.exit('No user called {!r}; add their games with add -u first'.format(args.user))
+    elif db.get_users():
+        #fetching's decided by everyone's subscriptions then; see database.USERS_SCHEMA
+        sys.exit('This DB has users; pick whose games to edit with -u')
+    try:
+        edit_fetch_games(args.partial_title, db, args.catalogue, userid)
+    except FileNotFoundError as e:
+        sys.exit(str(e))
+
+def cmd_users(db: NewsDatabase, args):
+    print_users(db)
+
+def cmd_history(db: NewsDatabase, args):
+    if args.slow_apps:
+        print_slow_apps(db, args.runs)
+    else:
+        print_run_history(db, args.runs)
+
+def cmd_failures(db: NewsDatabase, args):
+    if args.reset is not None:
+        reset = db.reset_fetch_failures(args.reset or None)
+        logger.info('Reset %d failing games', reset)
+    else:
+        print_fetch_failures(db)
+
+def cmd_fetch(db: NewsDatabase, args):
+    metrics = RunMetrics()
+    getAllRecentNews(db, metrics=metrics, **fetch_args(args))
+    if args.keep_days is not None or args.keep_items is not None:
+        db.prune_news(args.keep_days, args.keep_items)
+    db.incremental_vacuum()
+    publish_collected(db, args, metrics)
+    record_run(db, args, metrics)
+
+def cmd_publish(db: NewsDatabase, args):
+    metrics = RunMetrics()
+    publish_collected(db, args, metrics)
+    record_run(db, args, metrics)
+
+def cmd_prune(db: NewsDatabase, args):
+    if args.keep_days is not None or args.keep_items is not None:
+        db.prune_news(args.keep_days, args.keep_items)
+    if args.vacuum:
+        db.vacuum()
+    else:
+        db.incremental_vacuum()
+
+def cmd_serve(db: NewsDatabase, args):
+    import signal
+    host, _, port = args.address.rpartition(':')
+    feeds = collect_feeds(db, args, serving=True)
+    if not feeds and not args.user_feeds:
+        from NewsPublisher import FeedDefinition
+        feeds = [FeedDefinition('steam_news.xml')]
+    #so a service manager stopping us unwinds & closes the DB properly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve_feeds(db, feeds, host or '127.0.0.1', int(port), int(args.poll * 60),
+                fetch_args(args), (args.keep_days, args.keep_items), args.report, args.prom,
+                args.render_workers, args.user_feeds)
+    except ValueError as e:
+        sys.exit(str(e))
+    except KeyboardInterrupt:
+        logger.info('Stopped serving.')
+
+def make_parser():
+    #options shared between subcommands
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-v', '--verbose', action='store_true')
+    common.add_argument('--wal', action='store_true',
+            help='use SQLite WAL mode so publishing can read during a fetch')
+    common.add_argument('--compress', action='store_true',
+            help='zlib-compress the contents of newly fetched news items')
+
+    user = argparse.ArgumentParser(add_help=False)
+    user.add_argument('-u', '--user', metavar='name',
+            help="change that user's subscriptions instead (init & add add new users)")
+
+    fetching = argparse.ArgumentParser(add_help=False)
+    fetching.add_argument('-j', '--fetch-workers', type=int, default=1, metavar='N',
+            help='number of news requests to have in flight at once (default 1)')
+    fetching.add_argument('--fetch-rate', type=float, default=4.0, metavar='REQ/S',
+            help='max news requests per second across all workers (default 4)')
+    fetching.add_argument('--max-fetch', type=int, metavar='N',
+            help='only fetch the N most overdue games this run')
+    fetching.add_argument('--adaptive', action='store_true',
+            help='poll games less often the longer they go without posting news')
+    fetching.add_argument('--incremental', action='store_true',
+            help='ask for fewer news items from games we already have news for')
+    fetching.add_argument('--min-interval', type=float, default=1, metavar='HOURS',
+            help='shortest adaptive polling interval (default 1 hour)')
+    fetching.add_argument('--max-interval', type=float, default=24, metavar='HOURS',
+            help='longest adaptive polling interval (default 24 hours)')
+    fetching.add_argument('--commit-every', type=int, default=50, metavar='N',
+            help='commit fetched news to the DB once per N apps (default 50)')
+
+    keeping = argparse.ArgumentParser(add_help=False)
+    keeping.add_argument('--keep-days', type=int, metavar='DAYS',
+            help='delete news items older than this (should be 30+, the published window)')
+    keeping.add_argument('--keep-items', type=int, metavar='N',
+            help='delete all but the newest N news items')
+
+    publishing = argparse.ArgumentParser(add_help=False)
+    publishing.add_argument('-p', '--publish', metavar='XML output path')
+    publishing.add_argument('--feeds', metavar='JSON path',
+            help='publish every feed defined in this file, in one pass')
+    publishing.add_argument('--user-feeds', metavar='directory',
+            help="also publish each user's own feed to <directory>/<name>.xml")
+    publishing.add_argument('--render-workers', type=int, metavar='N',
+            help='render news items not published before with N processes')
+    publishing.add_argument('--force-publish', action='store_true',
+            help='rewrite the feed even if no news changed since it was last published')
+
+    reporting = argparse.ArgumentParser(add_help=False)
+    reporting.add_argument('--report', metavar='JSON path',
+            help='write timings & stats for the run to this file')
+    reporting.add_argument('--prom', metavar='path',
+            help='write timings & stats for the run as a Prometheus textfile')
+
     parser = argparse.ArgumentParser()
-    parser.add_argument('--first-run', action='store_true')
-    parser.add_argument('-a', '--add-profile-games', metavar='Steam ID|Vanity url')
-    parser.add_argument('-f', '--fetch', action='store_true')
-    parser.add_argument('-p', '--publish', metavar='XML output path')
-    parser.add_argument('-g', '--edit-games-like', metavar='partial title')
-    parser.add_argument('-v', '--verbose', action='store_true')
     #TODO maybe arg for DB path...?
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    cmd = commands.add_parser('init', parents=[common, user],
+            help="create the database, adding profiles' games if given")
+    cmd.add_argument('profiles', nargs='*', metavar='Steam ID|Vanity url')
+    cmd.set_defaults(func=cmd_init)
+
+    cmd = commands.add_parser('add', parents=[common, user],
+            help="add the games from (public) Steam profiles")
+    cmd.add_argument('profiles', nargs='+', metavar='Steam ID|Vanity url')
+    cmd.set_defaults(func=cmd_add)
+
+    cmd = commands.add_parser('edit', parents=[common, user],
+            help='pick which games with a title like this to fetch news for')
+    cmd.add_argument('partial_title')
+    cmd.add_argument('--catalogue', nargs='?', const='appids.db', metavar='appids.db',
+            help='search all of Steam (from app_id_discovery.py) to add unowned games')
+    cmd.set_defaults(func=cmd_edit)
+
+    cmd = commands.add_parser('users', parents=[common], help='list the users & their games')
+    cmd.set_defaults(func=cmd_users)
+
+    cmd = commands.add_parser('history', parents=[common],
+            help='list the latest fetch & publish runs, from the RunHistory table')
+    cmd.add_argument('-n', '--runs', type=int, default=20, metavar='N',
+            help='how many of the latest runs to look at (default 20)')
+    cmd.add_argument('--slow-apps', action='store_true',
+            help='list the apps that keep being among the slowest to fetch instead')
+    cmd.set_defaults(func=cmd_history)
+
+    cmd = commands.add_parser('failures', parents=[common],
+            help='list the games that keep failing to fetch')
+    cmd.add_argument('--reset', nargs='*', type=int, metavar='APPID',
+            help='retry these failing (or parked) games on the next fetch, or all of them')
+    cmd.set_defaults(func=cmd_failures)
+
+    cmd = commands.add_parser('fetch', parents=[common, fetching, keeping, publishing, reporting],
+            help='fetch news for the games that are due (& publish, if asked)')
+    cmd.set_defaults(func=cmd_fetch)
+
+    cmd = commands.add_parser('publish', parents=[common, publishing, reporting],
+            help='publish the recent news as RSS feeds')
+    cmd.set_defaults(func=cmd_publish)
+
+    cmd = commands.add_parser('prune', parents=[common, keeping],
+            help='delete old news & give the space back')
+    cmd.add_argument('--vacuum', action='store_true',
+            help='rebuild the DB & switch it to incremental vacuuming')
+    cmd.set_defaults(func=cmd_prune)
+
+    cmd = commands.add_parser('serve', parents=[common, fetching, keeping, publishing, reporting],
+            help='keep running, fetching as games come due & serving the feeds over HTTP')
+    cmd.add_argument('address', nargs='?', default='127.0.0.1:8080', metavar='[HOST:]PORT',
+            help='where to serve the feeds (default 127.0.0.1:8080)')
+    cmd.add_argument('--poll', type=float, default=15, metavar='MINUTES',
+            help='check for due games at least this often (default 15 minutes)')
+    cmd.set_defaults(func=cmd_serve)
+    return parser
+
+def main():
+    parser = make_parser()
     args = parser.parse_args()
+    if args.command == 'publish' and not (args.publish or args.feeds or args.user_feeds):
+        parser.error('publish needs -p, --feeds or --user-feeds')
 
     lvl = logging.INFO if not args.verbose else logging.DEBUG
     logging.basicConfig(stream=sys.stdout,
             format='%(asctime)s | %(name)s | %(levelname)s | %(message)s',
             level=lvl)
 
-    with NewsDatabase() as db:
-        if args.first_run:
-            db.first_run()
-
-        if args.add_profile_games:
-            seed_database(args.add_profile_games, db)
-
-        if args.edit_games_like:
-            edit_fetch_games(args.edit_games_like, db)
-        else: #editing is mutually exclusive w/ fetch & publish
-            if args.fetch:
-                newsids = db.get_fetch_games()
-                getAllRecentNews(newsids, db)
-
-            if args.publish:
-                publish(db, args.publish)
+    with NewsDatabase(wal=args.wal, compress=args.compress) as db:
+        args.func(db, args)
 
 if __name__ == '__main__':
     main()
@@ -1,48 +1,188 @@
 #!/usr/bin/env python3
 
+import argparse
+import io
+import json
+import os
 import sqlite3
 from urllib.request import urlopen
 from urllib.error import HTTPError
-import json
 
 APPLIST_URL = 'https://api.steampowered.com/ISteamApps/GetAppList/v0002/'
+APPIDS_DB = 'appids.db'
+
+#Full text index over the app names, kept in sync by triggers.
+#The trigram tokenizer gives us substring matches like LIKE '%...%' would,
+# but through an index (it needs SQLite 3.34+)
+APPIDS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS AppIDs (appid INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE VIRTUAL TABLE IF NOT EXISTS AppNames USING fts5(
+    name, content='AppIDs', content_rowid='appid', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS AppIDsInsert AFTER INSERT ON AppIDs BEGIN
+    INSERT INTO AppNames(rowid, name) VALUES (new.appid, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS AppIDsDelete AFTER DELETE ON AppIDs BEGIN
+    INSERT INTO AppNames(AppNames, rowid, name) VALUES ('delete', old.appid, old.name);
+END;
+CREATE TRIGGER IF NOT EXISTS AppIDsUpdate AFTER UPDATE ON AppIDs BEGIN
+    INSERT INTO AppNames(AppNames, rowid, name) VALUES ('delete', old.appid, old.name);
+    INSERT INTO AppNames(rowid, name) VALUES (new.appid, new.name);
+END;'''
+
+
+def iter_apps(stream, chunk_size=64 * 1024):
+    """Yield (appid, name) from a GetAppList response as it's read,
+    skipping apps with no name.
+    The raw JSON is 8+ MB, so rather than json.loads() the whole thing,
+    decode one app object at a time out of the "apps" array."""
+    decoder = json.JSONDecoder()
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    buf = text.read(chunk_size)
+    #The first [ is the start of the apps array: {"applist":{"apps":[...]}}
+    pos = buf.find('[')
+    while pos == -1:
+        chunk = text.read(chunk_size)
+        if not chunk:
+            raise ValueError('No app list found in the response')
+        buf += chunk
+        pos = buf.find('[')
+    pos += 1
+
+    while True:
+        #skip to the next object, or the end of the array
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        try:
+            app, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            #probably just cut off mid-object; get more & try again
+            chunk = text.read(chunk_size)
+            if not chunk:
+                raise
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        if app['name']:
+            yield app['appid'], app['name']
+
 
-def capture_and_save():
+def capture_and_save(path=APPIDS_DB, full=False):
+    """Download the app list into the appids db at path.
+    If it already exists, only the differences are applied to it
+    (unless full is set, which rebuilds it from scratch)."""
+    if full or not os.path.exists(path):
+        capture_full(path)
+    else:
+        capture_incremental(path)
+
+
+def capture_full(path):
     try:
         applist_resp = urlopen(APPLIST_URL)
-        applist = json.loads(applist_resp.read().decode('utf-8'))
-        del applist_resp #probably unnecessary memory saving
     except HTTPError as e:
         print('Failed to get the app list: ' + str(e))
         return
 
-    print('Got the app list.')
+    print('Got the app list; converting to db...')
     #note: The raw JSON is about 8 MB large as of October 2022;
     # even after filtering appids with empty names, the SQLite db is about 11 MB
     # running VACUUM after the fact reduced it to 5.4 MB
-    
-    #Remove apps with no name; convert the rest into nice tuples for db insertion
-    al = [(app['appid'], app['name']) for app in applist['applist']['apps'] if app['name']]
-    
-    print(f'Simplified the app list; has {len(al)} entries; converting to db...')
 
+    tmp_path = path + '.tmp'
     try:
         #Doing this on disk is oddly slow, so do it in memory, then write to disk after
         db = sqlite3.connect(':memory:', isolation_level=None)
         c = db.cursor()
-        c.execute('CREATE TABLE IF NOT EXISTS AppIDs (appid INTEGER PRIMARY KEY, name TEXT NOT NULL)')
-        c.executemany('INSERT OR REPLACE INTO AppIDs VALUES (?, ?)', al)
+        c.execute('CREATE TABLE AppIDs (appid INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        #Apps come straight from the download, no list of them in between
+        with applist_resp:
+            c.executemany('INSERT OR REPLACE INTO AppIDs VALUES (?, ?)',
+                    iter_apps(applist_resp))
+        print(f'Imported {db.execute("SELECT count(*) FROM AppIDs").fetchone()[0]} apps; indexing...')
+        #Bulk building the index is faster than letting the triggers do it row by row
+        c.executescript(APPIDS_SCHEMA)
+        c.execute("INSERT INTO AppNames(AppNames) VALUES ('rebuild')")
 
         print('Writing to disk...')
-        c.execute('VACUUM INTO "appids.db"')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        c.execute('VACUUM INTO ?', (tmp_path,))
     finally:
         db.close()
+    os.replace(tmp_path, path)
     print('Done!')
 
 
-#TODO search...?
-# $ sqlite3 appids.db 'SELECT * FROM AppIDs WHERE name LIKE "%steam%" ORDER BY name' >ids_with_steam.log
-#just combed by hand from there in a text editor
+def capture_incremental(path):
+    try:
+        applist_resp = urlopen(APPLIST_URL)
+    except HTTPError as e:
+        print('Failed to get the app list: ' + str(e))
+        return
+
+    print('Got the app list; comparing to the existing db...')
+    try:
+        db = sqlite3.connect(path, isolation_level=None)
+        c = db.cursor()
+        indexed = c.execute('''SELECT 1 FROM sqlite_master
+            WHERE name = 'AppNames' ''').fetchone()
+        c.executescript(APPIDS_SCHEMA)
+        if not indexed: #made before there was a search index
+            print('Indexing existing apps...')
+            c.execute("INSERT INTO AppNames(AppNames) VALUES ('rebuild')")
+        c.execute('CREATE TEMP TABLE Incoming (appid INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        with applist_resp:
+            c.executemany('INSERT OR REPLACE INTO Incoming VALUES (?, ?)',
+                    iter_apps(applist_resp))
+
+        c.execute('BEGIN')
+        #Only new & renamed apps get written (and re-indexed by the triggers)
+        c.execute('''INSERT INTO AppIDs SELECT appid, name FROM Incoming
+            WHERE NOT EXISTS (SELECT 1 FROM AppIDs
+                WHERE AppIDs.appid = Incoming.appid AND AppIDs.name = Incoming.name)
+            ON CONFLICT(appid) DO UPDATE SET name = excluded.name''')
+        changed = c.rowcount
+        c.execute('DELETE FROM AppIDs WHERE appid NOT IN (SELECT appid FROM Incoming)')
+        removed = c.rowcount
+        c.execute('COMMIT')
+    finally:
+        db.close()
+    print(f'Done! {changed} apps added or renamed, {removed} removed.')
+
+
+def search(term, path=APPIDS_DB, limit=50):
+    """Find apps with names containing term, best matches first"""
+    db = sqlite3.connect(path)
+    try:
+        term = term.strip()
+        if len(term) >= 3:
+            #quoted as an FTS phrase, so the trigram index does a substring match
+            c = db.execute('''SELECT AppIDs.appid, AppIDs.name FROM AppNames
+                JOIN AppIDs ON AppIDs.appid = AppNames.rowid
+                WHERE AppNames MATCH ? ORDER BY rank, length(AppIDs.name) LIMIT ?''',
+                ('"' + term.replace('"', '""') + '"', limit))
+        else: #too short for trigrams, so scan it is
+            c = db.execute('''SELECT appid, name FROM AppIDs
+                WHERE name LIKE ? ORDER BY length(name), name LIMIT ?''',
+                ('%' + term + '%', limit))
+        return c.fetchall()
+    finally:
+        db.close()
+
 
 if __name__ == '__main__':
-    capture_and_save()
+    parser = argparse.ArgumentParser(description='Download & search the list of all Steam apps')
+    parser.add_argument('-s', '--search', metavar='partial name',
+            help='search the app list instead of updating it')
+    parser.add_argument('--full', action='store_true',
+            help='rebuild the app list from scratch instead of updating it')
+    parser.add_argument('--db', default=APPIDS_DB, metavar='path')
+    args = parser.parse_args()
+
+    if args.search:
+        for appid, name in search(args.search, args.db):
+            print(f'{appid}|{name}')
+    else:
+        capture_and_save(args.db, args.full)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+# Check how much SteamNews.py imports before its subcommands get anything done,
+# using python -X importtime against a fresh, empty DB, e.g.
+#   ./benchmarks/check_import_time.py --budget 100
+# Exits non-zero if a subcommand imports a module it shouldn't need,
+# or its imports take longer than the budget (beyond what bare Python takes to start).
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SteamNews.py')
+
+#Only needed for publishing, serving, downloading profiles or whiptail
+PUBLISHING_MODULES = ('NewsPublisher', 'PyRSS2Gen', 'bbcode', 'difflib', 'multiprocessing',
+        'concurrent.futures.process', 'feed_server', 'http.server', 'subprocess',
+        'urllib.request', 'xml.etree.ElementTree')
+
+#name: (arguments, modules it mustn't import)
+COMMANDS = {
+    'fetch': (['fetch'], PUBLISHING_MODULES),
+    'failures': (['failures'], PUBLISHING_MODULES),
+    'users': (['users'], PUBLISHING_MODULES),
+    'history': (['history'], PUBLISHING_MODULES),
+    'prune': (['prune'], PUBLISHING_MODULES),
+    'publish': (['publish', '-p', 'check.xml'], ()),
+}
+
+
+def import_times(args, cwd):
+    """Run python -X importtime with args, returning {module: self microseconds}"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=cwd,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us)
+    return times
+
+
+def best_times(args, cwd, repeat):
+    """import_times for the quickest of `repeat` runs"""
+    runs = [import_times(args, cwd) for _ in range(repeat)]
+    return min(runs, key=lambda times: sum(times.values()))
+
+
+def check(budget_ms, repeat=5, verbose=False):
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run([sys.executable, SCRIPT, 'init'], cwd=tmp,
+                stdout=subprocess.DEVNULL, check=True)
+        baseline = best_times(['-c', 'pass'], tmp, repeat)
+        for name, (args, forbidden) in COMMANDS.items():
+            times = best_times([SCRIPT] + args, tmp, repeat)
+            extra = {module: us for module, us in times.items() if module not in baseline}
+            ms = sum(extra.values()) / 1000
+            bad = sorted(module for module in extra if module in forbidden)
+            #publishing is allowed to be slow to start; it's slow anyway
+            slow = forbidden and ms > budget_ms
+            ok = not bad and not slow
+            failures += not ok
+            print('{:<10} {:7.1f}ms {:4d} modules  {}'.format(name, ms, len(extra),
+                    'ok' if ok else 'FAILED'))
+            for module in bad:
+                print('    unwanted: ' + module)
+            if verbose or not ok:
+                for module, us in sorted(extra.items(), key=lambda m: m[1], reverse=True)[:15]:
+                    print('        {:7.1f}ms {}'.format(us / 1000, module))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the subcommands' startup imports")
+    parser.add_argument('--budget', type=float, default=150, metavar='MS',
+            help='most milliseconds of imports allowed, beyond bare Python (default 150)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the slowest imports')
+    args = parser.parse_args()
+    sys.exit(1 if check(args.budget, args.repeat, args.verbose) else 0)
+
+
+if __name__ == '__main__':
+    main()
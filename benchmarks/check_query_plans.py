@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Check that the queries run on every fetch & publish still use the indexes meant for them
+# (see HOT_INDEXES in database.py), using EXPLAIN QUERY PLAN on a synthetic DB, e.g.
+#   ./benchmarks/check_query_plans.py --games 5000 --items 50000
+# Exits non-zero if any plan is missing an index it should use, or scans what it shouldn't.
+
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import NewsDatabase
+from synth_db import make_db
+
+#Nothing hot should have to read through every news item
+ALWAYS_FORBIDDEN = ('SCAN NewsItems', 'SCAN NewsSources')
+
+#name: (what runs the query, plan lines it needs, plan lines it mustn't have)
+HOT_QUERIES = {
+    'due apps': (lambda db: db.get_due_games(),
+            ('FetchGamesIdx', 'COVERING INDEX NewsSourceAppGidIdx', 'COVERING INDEX NewsGidDateIdx'),
+            ()),
+    'games to fetch': (lambda db: db.get_fetch_games(), ('FetchGamesIdx',), ()),
+    'publish window': (lambda db: db.get_news_summary().fetchall(),
+            ('COVERING INDEX NewsWindowIdx',), ('TEMP B-TREE',)),
+    'recent sources': (lambda db: db.get_recent_sources(0).fetchall(),
+            ('COVERING INDEX NewsWindowIdx', 'COVERING INDEX sqlite_autoindex_NewsSources_1'), ()),
+    'sources per gid': (lambda db: db.get_news_rows().fetchall(),
+            ('NewsWindowIdx', 'COVERING INDEX sqlite_autoindex_NewsSources_1'), ()),
+    'game search': (lambda db: db.get_games_like('Space'), ('VIRTUAL TABLE INDEX',), ()),
+}
+
+
+def query_plans(db: NewsDatabase, run):
+    """Run a query (or a few) through run(db), returning each statement's plan lines"""
+    statements = []
+    db.db.set_trace_callback(statements.append)
+    try:
+        run(db)
+    finally:
+        db.db.set_trace_callback(None)
+    plans = []
+    for sql in statements:
+        #skip the bookkeeping the FTS module does behind the scenes
+        if not sql.lstrip().upper().startswith(('SELECT', 'WITH')) or '_config' in sql:
+            continue
+        plans.append((sql, [row[3] for row in db.db.execute('EXPLAIN QUERY PLAN ' + sql)]))
+    return plans
+
+
+def check(db: NewsDatabase, verbose=False):
+    failures = 0
+    for name, (run, needed, forbidden) in HOT_QUERIES.items():
+        plans = query_plans(db, run)
+        lines = [line for _, plan in plans for line in plan]
+        missing = [n for n in needed if not any(n in line for line in lines)]
+        bad = [line for line in lines if any(f in line for f in forbidden + ALWAYS_FORBIDDEN)]
+        ok = not missing and not bad
+        failures += not ok
+        print('{:<16} {}'.format(name, 'ok' if ok else 'FAILED'))
+        for n in missing:
+            print('    missing: ' + n)
+        for line in bad:
+            print('    unwanted: ' + line)
+        if verbose or not ok:
+            for sql, plan in plans:
+                print('    ' + ' '.join(sql.split())[:100])
+                for line in plan:
+                    print('        ' + line)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the hot queries use their indexes')
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--items', type=int, default=20000)
+    parser.add_argument('--fetching', type=float, default=0.2, metavar='FRACTION',
+            help='fraction of games with fetching left enabled')
+    parser.add_argument('--db', metavar='path', help='check an existing DB instead '
+            '(FetchGamesIdx only gets used when most games have fetching disabled)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show every plan')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if not db_path:
+            db_path = make_db(os.path.join(tmp, 'plans.db'), args.games, args.items)
+            with NewsDatabase(db_path) as db:
+                appids = sorted(db.get_fetch_games())
+                db.disable_fetching_ids(appids[int(len(appids) * args.fetching):])
+                db.db.execute('ANALYZE')
+        with NewsDatabase(db_path) as db:
+            failures = check(db, args.verbose)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Repeatable timings for the expensive parts of fetching & publishing,
+# against a synthetic DB & the local stub API (no network needed), e.g.
+#   ./benchmarks/run_benchmarks.py --games 5000 --items 100000 --latency 0.02 -j 8
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SteamNews
+import NewsPublisher
+from database import NewsDatabase
+from stub_steam import StubSteam, BBCODE_SAMPLE
+from synth_db import make_db
+
+SEARCH_TERMS = ('Space', 'dungeon sim', 'Quest 3', 'Zo', 'nothing like this')
+
+
+def timed(func, repeat, setup=None):
+    """Run func `repeat` times (after setup, untimed, each time) and return the timings"""
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def report(name, times, unit_count=None, unit=''):
+    line = '{:<36} min {:9.4f}s  median {:9.4f}s  max {:9.4f}s'.format(
+            name, min(times), statistics.median(times), max(times))
+    if unit_count:
+        line += '  ({:.1f} {}/s)'.format(unit_count / min(times), unit)
+    print(line, flush=True)
+
+
+def bench_fetch(db: NewsDatabase, args, stub: StubSteam):
+    def expire_all():
+        with db.db:
+            db.db.execute('UPDATE ExpireTimes SET unixseconds = 0')
+    games = len(db.get_due_games())
+    fetch = lambda: SteamNews.getAllRecentNews(db, workers=args.workers, rate=args.rate)
+    report('getAllRecentNews', timed(fetch, args.repeat, expire_all), games, 'apps')
+    #same again, for a Steam that sends the whole (unchanged) response every time
+    stub.conditional = False
+    report('getAllRecentNews (no 304s)', timed(fetch, args.repeat, expire_all), games, 'apps')
+    stub.conditional = True
+
+
+def bench_publish(db: NewsDatabase, args, out_path):
+    def clear_caches():
+        with db.db:
+            db.db.execute('DELETE FROM RenderedHTML')
+            db.db.execute('DELETE FROM RSSTitles')
+    items = sum(1 for _ in db.get_news_rows())
+    publish = lambda: NewsPublisher.publish(db, out_path, force=True)
+    report('publish (cold caches)', timed(publish, args.repeat, clear_caches), items, 'items')
+    for workers in sorted({2, 4, os.cpu_count() or 1} - {1}):
+        parallel = lambda: NewsPublisher.publish(db, out_path, force=True, workers=workers)
+        report('publish (cold caches, {} processes)'.format(workers),
+                timed(parallel, args.repeat, clear_caches), items, 'items')
+    report('publish (warm caches)', timed(publish, args.repeat), items, 'items')
+    report('publish (unchanged)', timed(lambda: NewsPublisher.publish(db, out_path), args.repeat))
+    #one feed of everything plus nine narrower ones, as a --feeds file might list
+    feeds = [NewsPublisher.FeedDefinition(out_path)] + [
+            NewsPublisher.FeedDefinition('{}.{}'.format(out_path, i), feed_types=[i % 2],
+                max_items=items // (i + 1)) for i in range(1, 10)]
+    publish_all = lambda: NewsPublisher.publish_feeds(db, feeds, force=True)
+    report('publish_feeds (10 feeds)', timed(publish_all, args.repeat), items, 'items')
+
+
+def bench_bbcode(args):
+    posts = [BBCODE_SAMPLE * n for n in range(1, 9)] * 25
+    render = lambda: [NewsPublisher.convertBBCodeToHTML(p) for p in posts]
+    report('convertBBCodeToHTML', timed(render, args.repeat), len(posts), 'posts')
+
+
+def bench_search(db: NewsDatabase, args):
+    for term in SEARCH_TERMS:
+        report('get_games_like({!r})'.format(term),
+                timed(lambda: db.get_games_like(term), args.repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fetching & publishing offline')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS',
+            help='stub API latency per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION')
+    parser.add_argument('-j', '--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=10000.0, metavar='REQ/S')
+    parser.add_argument('--db', metavar='path',
+            help='use an existing DB instead of generating one (fetching will modify it!)')
+    parser.add_argument('--only', nargs='+', choices=('fetch', 'publish', 'bbcode', 'search'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    only = set(args.only or ('fetch', 'publish', 'bbcode', 'search'))
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if not db_path:
+            start = time.perf_counter()
+            db_path = make_db(os.path.join(tmp, 'bench.db'), args.games, args.items)
+            print('Generated {} games & {} items in {:.1f}s'.format(
+                    args.games, args.items, time.perf_counter() - start))
+
+        with NewsDatabase(db_path) as db, StubSteam(latency=args.latency,
+                error_rate=args.error_rate) as stub:
+            SteamNews.API_BASE = stub.base_url
+            SteamNews.PROFILE_BASE = stub.base_url
+            if 'fetch' in only:
+                bench_fetch(db, args, stub)
+            if 'publish' in only:
+                bench_publish(db, args, os.path.join(tmp, 'bench.xml'))
+            if 'bbcode' in only:
+                bench_bbcode(args)
+            if 'search' in only:
+                bench_search(db, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+# A local stand-in for the bits of Steam's APIs that SteamNews.py talks to:
+#  /ISteamNews/GetNewsForApp/v0002/?appid=...&count=...
+#  /profiles/<steamid>/games?xml=1 and /id/<vanity>/games?xml=1
+# News is made up, but stable per appid, so ETags & conditional requests work.
+# Point SteamNews.API_BASE & SteamNews.PROFILE_BASE at it to use it.
+
+import argparse
+from email.utils import formatdate
+import hashlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import json
+import random
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+
+BBCODE_SAMPLE = '''[h2]Patch notes[/h2]
+[list]
+[*] Fixed a [b]crash[/b] when loading saves
+[*] Improved performance in [i]large[/i] levels
+[*] [url=https://example.com/forum]Discuss on the forums[/url]
+[/list]
+[img]{STEAM_CLAN_IMAGE}/1234/abcdef.png[/img]
+[previewyoutube=dQw4w9WgXcQ;full][/previewyoutube]
+'''
+
+
+def make_news(appid, count, now):
+    """Made-up news for appid; the same for the same appid & count within an hour"""
+    rng = random.Random(appid)
+    #Most games are dormant, some post all the time
+    gap = rng.choice((3600 * 6, 86400, 86400 * 7, 86400 * 90, 86400 * 400))
+    newest = (now // 3600) * 3600 - rng.randrange(gap)
+    items = []
+    for i in range(count):
+        community = rng.random() < 0.6
+        items.append({
+            'gid': str(appid * 1000 + i),
+            'title': 'Update {} for game {}'.format(count - i, appid),
+            'url': 'https://example.com/news/{}/{}'.format(appid, i),
+            'is_external_url': not community,
+            'author': 'dev{}'.format(appid % 17),
+            'contents': BBCODE_SAMPLE * rng.randint(1, 8) if community else 'Plain news text. ' * 40,
+            'feedlabel': 'Community Announcements' if community else 'Example News',
+            'date': newest - i * gap,
+            'feedname': 'steam_community_announcements' if community else 'example_news',
+            'feed_type': 1 if community else 0,
+            'appid': appid,
+        })
+    return {'appnews': {'appid': appid, 'newsitems': items, 'count': count}}
+
+
+def make_games_xml(count):
+    games = ''.join('<game><appID>{0}</appID><name><![CDATA[Game {0}]]></name>'
+            '<logo><![CDATA[https://example.com/{0}.jpg]]></logo></game>\n'.format(10 * (i + 1))
+            for i in range(count))
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<gamesList><steamID64>76561197960287930</steamID64>'
+            '<steamID><![CDATA[stub]]></steamID><games>\n{}</games></gamesList>'.format(games))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' #keep-alive, like the real thing
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.count_request()
+        if stub.latency:
+            time.sleep(stub.latency)
+        parts = urlsplit(self.path)
+        if parts.path.startswith('/ISteamNews/GetNewsForApp/'):
+            self.news(stub, parse_qs(parts.query))
+        elif parts.path.endswith('/games'):
+            self.send_body(200, stub.profile_xml.encode('utf-8'), 'text/xml')
+        else:
+            self.send_body(404, b'Not Found', 'text/plain')
+
+    def news(self, stub, query):
+        appid = int(query['appid'][0])
+        if appid in stub.broken:
+            status = stub.broken[appid]
+            return self.send_body(status, self.responses[status][0].encode('utf-8'), 'text/html')
+        if stub.error_rate and stub.rng.random() < stub.error_rate:
+            status = stub.error_status
+            return self.send_body(status, self.responses[status][0].encode('utf-8'), 'text/html',
+                    [('Retry-After', '1')] if status in (429, 503) else ())
+        count = int(query.get('count', ['10'])[0])
+        body = json.dumps(make_news(appid, count, int(time.time()))).encode('utf-8')
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        headers = [('ETag', etag), ('Expires', formatdate(time.time() + stub.expires, usegmt=True))]
+        if stub.conditional and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            for header in headers:
+                self.send_header(*header)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_body(200, body, 'application/json; charset=UTF-8', headers)
+
+
+class StubSteam:
+    """Runs the stub server on a background thread; use as a context manager.
+    latency: seconds to wait before every response
+    expires: seconds from now for the Expires header
+    error_rate: fraction of news requests that get an error_status (e.g. 500, or 429)
+    broken: {appid: status} of apps whose news requests always fail
+    conditional: whether to answer If-None-Match with 304s (Steam often doesn't)"""
+    def __init__(self, port=0, latency=0.0, expires=300, error_rate=0.0, profile_games=500,
+            error_status=500, broken=None, conditional=True):
+        self.latency = latency
+        self.expires = expires
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.broken = broken or {}
+        self.conditional = conditional
+        self.profile_xml = make_games_xml(profile_games)
+        self.rng = random.Random(0)
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def count_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a fake Steam news API locally')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS')
+    parser.add_argument('--expires', type=int, default=300, metavar='SECONDS')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION')
+    parser.add_argument('--error-status', type=int, default=500, metavar='STATUS')
+    parser.add_argument('--profile-games', type=int, default=500, metavar='N')
+    parser.add_argument('--no-304', action='store_true', help='ignore conditional requests')
+    args = parser.parse_args()
+    stub = StubSteam(args.port, args.latency, args.expires, args.error_rate, args.profile_games,
+            args.error_status, conditional=not args.no_304)
+    print('Serving on {}'.format(stub.base_url))
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# Generate a SteamNews.db full of made-up games & news, for benchmarking
+# e.g. ./benchmarks/synth_db.py --games 50000 --items 1000000 big.db
+
+import argparse
+from itertools import islice
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import NewsDatabase
+from stub_steam import BBCODE_SAMPLE
+
+WORDS = ('Space', 'Dungeon', 'Simulator', 'Legends', 'Tactics', 'Farm', 'Quest',
+        'Racing', 'Zombie', 'Empire', 'Puzzle', 'Night', 'Hero', 'Craft', 'Odyssey')
+
+
+def synth_games(rng, count):
+    for i in range(count):
+        name = ' '.join(rng.sample(WORDS, rng.randint(1, 3)))
+        if rng.random() < 0.3:
+            name += ' {}'.format(rng.randint(2, 5))
+        yield 10 * (i + 1), name
+
+
+def synth_items(rng, appids, count, now, days):
+    for i in range(count):
+        appid = rng.choice(appids)
+        community = rng.random() < 0.6
+        yield {
+            'gid': str(5000000000000000000 + i),
+            'title': 'Update {} is out'.format(rng.randint(1, 200)),
+            'url': 'https://example.com/news/{}'.format(i),
+            'is_external_url': not community,
+            'author': 'dev{}'.format(appid % 17),
+            'contents': BBCODE_SAMPLE * rng.randint(1, 8) if community else 'Plain news text. ' * 40,
+            'feedlabel': 'Community Announcements' if community else 'Example News',
+            'date': now - rng.randrange(days * 86400),
+            'feedname': 'steam_community_announcements' if community else 'example_news',
+            'feed_type': 1 if community else 0,
+            'appid': appid,
+            'realappid': appid,
+        }
+
+
+def make_db(path, games=1000, items=10000, days=60, crosspost=0.05, seed=0, compress=False):
+    """Create a DB at path with `games` games & `items` news items spread over `days` days.
+    A `crosspost` fraction of items gets an extra source game."""
+    rng = random.Random(seed)
+    now = int(time.time())
+    if os.path.exists(path):
+        os.remove(path)
+    with NewsDatabase(path, compress=compress) as db:
+        db.first_run()
+        db.add_games(synth_games(rng, games))
+        appids = [10 * (i + 1) for i in range(games)]
+        db.write_batch([(appid, 0, None, None, None) for appid in appids], [])
+        neds = synth_items(rng, appids, items, now, days)
+        while True:
+            chunk = list(islice(neds, 10000))
+            if not chunk:
+                break
+            db.write_batch([], chunk)
+        extra = [(str(5000000000000000000 + i), rng.choice(appids))
+                for i in range(items) if rng.random() < crosspost]
+        with db.db:
+            db.db.executemany('INSERT OR IGNORE INTO NewsSources VALUES (?, ?)', extra)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic SteamNews.db')
+    parser.add_argument('path')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=60, help='spread news dates over this many days')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args()
+    make_db(args.path, args.games, args.items, args.days, seed=args.seed, compress=args.compress)
+    print('Wrote {}'.format(args.path))
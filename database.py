@@ -1,12 +1,211 @@
 import sqlite3
+import json
 import logging
+import os
 import time
+import zlib
 
 logger = logging.getLogger(__name__)
 
+UPSERT_EXPIRE_TIME = '''INSERT INTO ExpireTimes VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(appid) DO UPDATE SET
+        unixseconds = excluded.unixseconds,
+        etag = coalesce(excluded.etag, etag),
+        last_modified = coalesce(excluded.last_modified, last_modified),
+        body_hash = coalesce(excluded.body_hash, body_hash)'''
+INSERT_NEWS_ITEM = '''INSERT OR IGNORE INTO NewsItems(gid, title, url, is_external_url,
+        author, contents, feedlabel, date, feedname, feed_type, appid, compressed)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+INSERT_NEWS_SOURCE = 'INSERT OR IGNORE INTO NewsSources VALUES (?, ?)'
+UPSERT_FETCH_FAILURE = 'INSERT OR REPLACE INTO FetchFailures VALUES (?, ?, ?, ?, ?, ?, ?)'
+#Publishing caches: BBCode rendered to HTML (see NewsPublisher.renderContents),
+# titles with their game names added (see NewsPublisher.decorateTitle),
+# and what each output file was last published from (see NewsPublisher.publish)
+CACHE_TABLES = '''
+CREATE TABLE RenderedHTML(
+    gid TEXT NOT NULL PRIMARY KEY
+        REFERENCES NewsItems(gid) ON DELETE CASCADE ON UPDATE CASCADE,
+    content_hash TEXT NOT NULL,
+    renderer INTEGER NOT NULL,
+    html TEXT NOT NULL);
+CREATE TABLE RSSTitles(
+    gid TEXT NOT NULL PRIMARY KEY
+        REFERENCES NewsItems(gid) ON DELETE CASCADE ON UPDATE CASCADE,
+    sources TEXT NOT NULL,
+    rsstitle TEXT NOT NULL);
+CREATE TABLE PublishState(
+    path TEXT NOT NULL PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    unixseconds INTEGER NOT NULL DEFAULT (strftime('%s')));'''
+
+#One row per fetch/publish run, see metrics.RunMetrics.report for the report JSON
+RUN_HISTORY_TABLE = '''
+CREATE TABLE RunHistory(
+    runid INTEGER PRIMARY KEY,
+    started INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    report TEXT NOT NULL);'''
+#Only the newest this many runs are kept; serving adds one as often as every minute
+RUN_HISTORY_KEEP = 2000
+
+#Consecutive fetch failures per app; a row is cleared as soon as a fetch works.
+#parked apps (the circuit breaker's open) get left alone until retry_at
+FETCH_FAILURES_TABLE = '''
+CREATE TABLE FetchFailures(
+    appid INTEGER PRIMARY KEY
+        REFERENCES Games(appid) ON DELETE CASCADE ON UPDATE CASCADE,
+    failures INTEGER NOT NULL,
+    last_status INTEGER,
+    last_error TEXT,
+    last_failed INTEGER NOT NULL,
+    retry_at INTEGER NOT NULL,
+    parked INTEGER NOT NULL DEFAULT 0);'''
+
+#Several people can share one DB: each User subscribes to their own games
+# (with their own enabled flags), & Games.shouldFetch is kept (by the triggers)
+# to whether anyone's subscribed & enabled, so each game's fetched once for all of them.
+#Games nobody's subscribed to keep whatever shouldFetch they had.
+USERS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS Users(
+    userid INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS Subscriptions(
+    userid INTEGER NOT NULL
+        REFERENCES Users(userid) ON DELETE CASCADE ON UPDATE CASCADE,
+    appid INTEGER NOT NULL
+        REFERENCES Games(appid) ON DELETE CASCADE ON UPDATE CASCADE,
+    enabled INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY(userid, appid)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS SubscriptionAppIdx ON Subscriptions(appid, enabled);
+CREATE TRIGGER IF NOT EXISTS SubscriptionsInsert AFTER INSERT ON Subscriptions BEGIN
+    UPDATE Games SET shouldFetch = EXISTS (SELECT 1 FROM Subscriptions
+        WHERE appid = new.appid AND enabled != 0) WHERE appid = new.appid;
+END;
+CREATE TRIGGER IF NOT EXISTS SubscriptionsUpdate AFTER UPDATE OF enabled ON Subscriptions BEGIN
+    UPDATE Games SET shouldFetch = EXISTS (SELECT 1 FROM Subscriptions
+        WHERE appid = new.appid AND enabled != 0) WHERE appid = new.appid;
+END;
+CREATE TRIGGER IF NOT EXISTS SubscriptionsDelete AFTER DELETE ON Subscriptions BEGIN
+    UPDATE Games SET shouldFetch = EXISTS (SELECT 1 FROM Subscriptions
+        WHERE appid = old.appid AND enabled != 0) WHERE appid = old.appid;
+END;'''
+
+#Full text index over game names for get_games_like, kept in sync by triggers.
+#The trigram tokenizer does substring matches like LIKE '%...%', but indexed
+# (same as AppNames in app_id_discovery's appids.db)
+GAME_NAMES_INDEX = '''
+CREATE VIRTUAL TABLE GameNames USING fts5(
+    name, content='Games', content_rowid='appid', tokenize='trigram');
+CREATE TRIGGER GamesInsert AFTER INSERT ON Games BEGIN
+    INSERT INTO GameNames(rowid, name) VALUES (new.appid, new.name);
+END;
+CREATE TRIGGER GamesDelete AFTER DELETE ON Games BEGIN
+    INSERT INTO GameNames(GameNames, rowid, name) VALUES ('delete', old.appid, old.name);
+END;
+CREATE TRIGGER GamesUpdate AFTER UPDATE OF appid, name ON Games BEGIN
+    INSERT INTO GameNames(GameNames, rowid, name) VALUES ('delete', old.appid, old.name);
+    INSERT INTO GameNames(rowid, name) VALUES (new.appid, new.name);
+END;'''
+
+def _fts_phrase(term):
+    """Quote term as an FTS5 phrase, so it's matched literally"""
+    return '"' + term.replace('"', '""') + '"'
+
+#The items that get published: everything from the last 30 days.
+#sadly our sqlite3 version isn't new enough for unixepoch()
+# so we have to use strftime('%s') for sqlite to make a unix timestamp
+#contents are decompressed here (see NewsDatabase.compress) so nothing else has to care.
+RECENT_WINDOW = "date >= strftime('%s', 'now', '-30 day')"
+RECENT_NEWS = '''SELECT gid, title, url, is_external_url, author,
+        CASE WHEN compressed THEN inflate(contents) ELSE contents END AS contents,
+        feedlabel, date, feedname, feed_type, appid
+    FROM NewsItems WHERE ''' + RECENT_WINDOW
+
+#Separates game names in get_news_rows' sources column; char(31) in SQL
+SOURCE_SEP = '\x1f'
+
+#Contents shorter than this aren't worth compressing
+COMPRESS_MIN_LENGTH = 512
+
+def _inflate(blob):
+    return zlib.decompress(blob).decode('utf-8')
+
+#Indexes for the queries run on every fetch & publish:
+# NewsWindowIdx covers get_news_summary & get_recent_sources (& the date range for the rest),
+# NewsGidDateIdx gets get_due_games its last_post without reading whole (big) items,
+# NewsSourceAppGidIdx covers the per-app side of NewsSources,
+# FetchGamesIdx covers the games to fetch without reading the disabled ones
+HOT_INDEXES = '''
+CREATE INDEX IF NOT EXISTS NewsWindowIdx ON NewsItems(date, gid, feed_type, feedname, feedlabel);
+CREATE INDEX IF NOT EXISTS NewsGidDateIdx ON NewsItems(gid, date);
+CREATE INDEX IF NOT EXISTS NewsSourceAppGidIdx ON NewsSources(appid, gid);
+CREATE INDEX IF NOT EXISTS FetchGamesIdx ON Games(appid, name, shouldFetch) WHERE shouldFetch != 0;'''
+
+
+#Schema migrations, oldest first; a DB's PRAGMA user_version is how many it's had.
+#first_run makes the latest schema outright, so these only ever run on older DBs.
+#Each one should be safe to run again, in case it's interrupted before the version bump.
+
+def _migrate_unversioned(db: sqlite3.Connection):
+    """1: Catch up DBs from before versioning, which might be missing any of these"""
+    cols = {row[1] for row in db.execute('PRAGMA table_info(ExpireTimes)')}
+    if 'etag' not in cols:
+        with db:
+            db.execute('ALTER TABLE ExpireTimes ADD COLUMN etag TEXT')
+            db.execute('ALTER TABLE ExpireTimes ADD COLUMN last_modified TEXT')
+        logger.info('Added HTTP validator columns to ExpireTimes')
+    cols = {row[1] for row in db.execute('PRAGMA table_info(NewsItems)')}
+    if 'compressed' not in cols:
+        with db:
+            db.execute('ALTER TABLE NewsItems ADD COLUMN compressed INTEGER NOT NULL DEFAULT 0')
+        logger.info('Added compression marker column to NewsItems')
+    if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'GameNames'").fetchone():
+        db.executescript(GAME_NAMES_INDEX)
+        with db:
+            db.execute("INSERT INTO GameNames(GameNames) VALUES ('rebuild')")
+        logger.info('Indexed game names for searching')
+    db.executescript((CACHE_TABLES + RUN_HISTORY_TABLE + FETCH_FAILURES_TABLE).replace(
+            'CREATE TABLE', 'CREATE TABLE IF NOT EXISTS'))
+
+def _migrate_hot_indexes(db: sqlite3.Connection):
+    """2: Index for the hot queries; the new indexes cover what the old ones did"""
+    db.executescript(HOT_INDEXES + '''
+        DROP INDEX IF EXISTS NewsDateIdx;
+        DROP INDEX IF EXISTS NewsSourceAppIDIdx;
+        ANALYZE;''')
+
+def _migrate_users(db: sqlite3.Connection):
+    """3: Users & their subscriptions"""
+    db.executescript(USERS_SCHEMA)
+
+def _migrate_body_hash(db: sqlite3.Connection):
+    """4: Hash of each app's last news response"""
+    cols = {row[1] for row in db.execute('PRAGMA table_info(ExpireTimes)')}
+    if 'body_hash' not in cols:
+        with db:
+            db.execute('ALTER TABLE ExpireTimes ADD COLUMN body_hash TEXT')
+
+def _migrate_run_history(db: sqlite3.Connection):
+    """5: Key RunHistory by rowid, so runs starting in the same second all get kept"""
+    cols = {row[1] for row in db.execute('PRAGMA table_info(RunHistory)')}
+    if 'runid' not in cols:
+        db.executescript('BEGIN;' + RUN_HISTORY_TABLE.replace('RunHistory', 'NewRunHistory')
+                + '''INSERT INTO NewRunHistory(started, seconds, report)
+                    SELECT started, seconds, report FROM RunHistory ORDER BY started;
+                DROP TABLE RunHistory;
+                ALTER TABLE NewRunHistory RENAME TO RunHistory;
+                COMMIT;''')
+
+MIGRATIONS = (_migrate_unversioned, _migrate_hot_indexes, _migrate_users, _migrate_body_hash,
+        _migrate_run_history)
+SCHEMA_VERSION = len(MIGRATIONS)
+
 class NewsDatabase:
-    def __init__(self, path=None):
+    def __init__(self, path=None, wal=False, compress=False):
         self.path = path or 'SteamNews.db'
+        self.wal = wal
+        #zlib new items' contents (only when it helps) & mark them as compressed
+        self.compress = compress
         self.db = None
 
     def open(self):
@@ -15,6 +214,17 @@ class NewsDatabase:
             self.db = sqlite3.connect(self.path)
             self.db.row_factory = sqlite3.Row
             self.db.execute('PRAGMA foreign_keys = ON')
+            self.db.create_function('inflate', 1, _inflate, deterministic=True)
+            if not self.db.execute('SELECT 1 FROM sqlite_master').fetchone():
+                #A brand new DB; auto_vacuum has to be set before anything
+                # (even switching to WAL) writes the header, so first_run's is too late
+                self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            if self.wal:
+                #WAL lets the publisher read while a fetch is writing;
+                # NORMAL sync is still crash-safe in WAL mode, just skips some fsyncs
+                self.db.execute('PRAGMA journal_mode = WAL')
+                self.db.execute('PRAGMA synchronous = NORMAL')
+            self._migrate()
 
     def close(self, optimize=True):
         if self.db:
@@ -34,10 +244,29 @@ class NewsDatabase:
         self.close(optimize=exc_type is None)
         return False
 
+    def _migrate(self):
+        """Bring DBs made by older versions up to date, one migration at a time."""
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version > SCHEMA_VERSION:
+            logger.warning('DB schema version %d is newer than this code knows (%d)',
+                    version, SCHEMA_VERSION)
+        if version >= SCHEMA_VERSION:
+            return
+        if not self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'ExpireTimes'").fetchone():
+            return #first_run hasn't happened yet
+        for version in range(version, SCHEMA_VERSION):
+            MIGRATIONS[version](self.db)
+            with self.db as db:
+                db.execute('PRAGMA user_version = {}'.format(version + 1))
+            logger.info('Upgraded DB to schema version %d', version + 1)
+
     def first_run(self):
         #The indentation here is more for the benefit of the sqlite3 tool
         # than the python source... /shrug
+        #New DBs can reuse free pages via incremental_vacuum() for free;
+        # old ones need a vacuum(incremental=True) to switch over
         self.db.executescript('''
+PRAGMA auto_vacuum = INCREMENTAL;
 CREATE TABLE Games(
     appid INTEGER PRIMARY KEY,
     name TEXT NOT NULL,
@@ -45,7 +274,10 @@ CREATE TABLE Games(
 CREATE TABLE ExpireTimes(
     appid INTEGER PRIMARY KEY
         REFERENCES Games(appid) ON DELETE CASCADE ON UPDATE CASCADE,
-    unixseconds INTEGER NOT NULL DEFAULT 0);
+    unixseconds INTEGER NOT NULL DEFAULT 0,
+    etag TEXT,
+    last_modified TEXT,
+    body_hash TEXT);
 CREATE TABLE NewsItems(
     gid TEXT NOT NULL PRIMARY KEY,
     title TEXT NOT NULL,
@@ -57,15 +289,17 @@ CREATE TABLE NewsItems(
     date INTEGER NOT NULL DEFAULT (strftime('%s')),
     feedname TEXT,
     feed_type INTEGER,
-    appid INTEGER NOT NULL);
+    appid INTEGER NOT NULL,
+    compressed INTEGER NOT NULL DEFAULT 0);
 CREATE TABLE NewsSources(
     gid TEXT NOT NULL
         REFERENCES NewsItems(gid) ON DELETE CASCADE ON UPDATE CASCADE,
     appid INTEGER NOT NULL
         REFERENCES Games(appid) ON DELETE CASCADE ON UPDATE CASCADE,
     PRIMARY KEY(gid, appid));
-CREATE INDEX NewsDateIdx ON NewsItems(date);
-CREATE INDEX NewsSourceAppIDIdx ON NewsSources(appid);''')
+''' + HOT_INDEXES + GAME_NAMES_INDEX + CACHE_TABLES
+        + RUN_HISTORY_TABLE + FETCH_FAILURES_TABLE + USERS_SCHEMA
+        + 'PRAGMA user_version = {};'.format(SCHEMA_VERSION))
 
         #having news item appid foreign key on games can break,
         # since the news appid might not be the one we fetched against
@@ -74,24 +308,78 @@ CREATE INDEX NewsSourceAppIDIdx ON NewsSources(appid);''')
         self.db.commit()
         logger.info('Created DB tables!')
 
-    def add_games(self, games: dict):
-        """Given a dict of appid: name, populate them in the database."""
+    def add_games(self, games):
+        """Given a dict of appid: name (or an iterable of such pairs),
+        populate them in the database."""
+        if isinstance(games, dict):
+            games = games.items()
         with self.db as db:
-            cur = db.executemany('INSERT OR IGNORE INTO Games VALUES (?, ?, 1)',
-                    games.items())
+            cur = db.executemany('INSERT OR IGNORE INTO Games VALUES (?, ?, 1)', games)
             logger.info('Added %d new games to be fetched.', cur.rowcount)
 
-    def get_games_like(self, name: str):
+    def get_games_like(self, name: str, catalogue=None, limit=500, userid=None):
+        """Search for games with name in their names, names starting with it first.
+        Rows have the Games columns, plus `owned` (whether it's in Games).
+        If catalogue is the path to an appids.db from app_id_discovery,
+        search all of Steam in there instead, so unowned games can be found too.
+        For a user, `owned` & `shouldFetch` are about their subscriptions instead."""
+        games = self._get_games_like(name, catalogue, limit)
+        if userid is None:
+            return games
+        subscribed = self.get_subscriptions(userid)
+        return [dict(game, shouldFetch=subscribed.get(game['appid'], 0),
+                owned=int(game['appid'] in subscribed)) for game in games]
+
+    def _get_games_like(self, name, catalogue, limit):
         #Since you can't do '%?%' in the SQL, do that here instead
         name = name.strip().strip('%')
-        if name:
-            n = '%' + name + '%'
-            c = self.db.execute('''SELECT * FROM Games
-                WHERE name LIKE ? ORDER BY name''', (n,))
+        if catalogue:
+            return self._get_catalogue_games_like(name, catalogue, limit)
+        if len(name) >= 3:
+            c = self.db.execute('''SELECT Games.*, 1 AS owned
+                FROM GameNames JOIN Games ON Games.appid = GameNames.rowid
+                WHERE GameNames MATCH ?
+                ORDER BY Games.name NOT LIKE ?, rank, Games.name''',
+                (_fts_phrase(name), name + '%'))
+        elif name: #too short for trigrams
+            c = self.db.execute('''SELECT *, 1 AS owned FROM Games
+                WHERE name LIKE ? ORDER BY name NOT LIKE ?, name''',
+                ('%' + name + '%', name + '%'))
         else:
-            c = self.db.execute('SELECT * FROM Games ORDER BY name')
+            c = self.db.execute('SELECT *, 1 AS owned FROM Games ORDER BY name')
         return c.fetchall()
 
+    def _get_catalogue_games_like(self, name, catalogue, limit):
+        #ATTACH would make an empty one, which app_id_discovery.py would then try to update
+        if not os.path.isfile(catalogue):
+            raise FileNotFoundError('No app catalogue at {}; '
+                    'download one with app_id_discovery.py first'.format(catalogue))
+        self.db.execute('ATTACH DATABASE ? AS catalogue', (catalogue,))
+        try:
+            #ones from before app_id_discovery.py indexed names can still be searched, slowly
+            indexed = self.db.execute('''SELECT 1 FROM catalogue.sqlite_master
+                WHERE name = 'AppNames' ''').fetchone()
+            if not indexed:
+                logger.info('%s has no name index; app_id_discovery.py will add one', catalogue)
+            if len(name) >= 3 and indexed:
+                c = self.db.execute('''SELECT a.appid, a.name,
+                        coalesce(g.shouldFetch, 0) AS shouldFetch, g.appid IS NOT NULL AS owned
+                    FROM catalogue.AppNames JOIN catalogue.AppIDs a ON a.appid = AppNames.rowid
+                        LEFT JOIN Games g ON g.appid = a.appid
+                    WHERE AppNames MATCH ?
+                    ORDER BY a.name NOT LIKE ?, rank, a.name LIMIT ?''',
+                    (_fts_phrase(name), name + '%', limit))
+            else:
+                c = self.db.execute('''SELECT a.appid, a.name,
+                        coalesce(g.shouldFetch, 0) AS shouldFetch, g.appid IS NOT NULL AS owned
+                    FROM catalogue.AppIDs a LEFT JOIN Games g ON g.appid = a.appid
+                    WHERE a.name LIKE ?
+                    ORDER BY a.name NOT LIKE ?, a.name LIMIT ?''',
+                    ('%' + name + '%', name + '%', limit))
+            return c.fetchall()
+        finally:
+            self.db.execute('DETACH DATABASE catalogue')
+
     def disable_fetching_ids(self, appids):
         with self.db as db:
             #sadly can't use executemany() w/ a "bare" list-- each item needs to be a tuple
@@ -103,49 +391,324 @@ CREATE INDEX NewsSourceAppIDIdx ON NewsSources(appid);''')
             for aid in appids:
                 db.execute('UPDATE Games SET shouldFetch = 1 WHERE appid = ?', (aid,))
 
+    def add_user(self, name):
+        """Get the userid for name, adding them if they're new"""
+        with self.db as db:
+            db.execute('INSERT OR IGNORE INTO Users(name) VALUES (?)', (name,))
+            return db.execute('SELECT userid FROM Users WHERE name = ?', (name,)).fetchone()[0]
+
+    def get_user(self, name):
+        row = self.db.execute('SELECT userid FROM Users WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def get_users(self):
+        """Get every user, with how many games they subscribe to & have enabled"""
+        c = self.db.execute('''SELECT userid, name, count(appid) AS games,
+                coalesce(sum(enabled != 0), 0) AS enabled
+            FROM Users LEFT JOIN Subscriptions USING (userid)
+            GROUP BY userid ORDER BY name''')
+        return c.fetchall()
+
+    def subscribe(self, userid, games):
+        """Add games (as for add_games) to the DB & subscribe the user to them.
+        Games they're already subscribed to keep their enabled flags."""
+        if isinstance(games, dict):
+            games = games.items()
+        games = list(games)
+        self.add_games(games)
+        with self.db as db:
+            c = db.executemany('INSERT OR IGNORE INTO Subscriptions(userid, appid) VALUES (?, ?)',
+                    ((userid, appid) for appid, _ in games))
+            logger.info('Subscribed to %d more games.', c.rowcount)
+
+    def get_subscriptions(self, userid):
+        """Get {appid: enabled} for the user's games"""
+        c = self.db.execute('SELECT appid, enabled FROM Subscriptions WHERE userid = ?',
+                (userid,))
+        return dict(c.fetchall())
+
+    def set_subscriptions_enabled(self, userid, appids, enabled=True):
+        """Turn the user's games (subscribing them, if need be) on or off"""
+        with self.db as db:
+            db.executemany('''INSERT INTO Subscriptions VALUES (?, ?, ?)
+                ON CONFLICT(userid, appid) DO UPDATE SET enabled = excluded.enabled''',
+                ((userid, appid, int(enabled)) for appid in appids))
+
     def get_fetch_games(self):
         c = self.db.execute('SELECT appid, name FROM Games WHERE shouldFetch != 0')
         return dict(c.fetchall())
 
-    def update_expire_time(self, appid, expires):
+    def update_expire_time(self, appid, expires, etag=None, last_modified=None,
+            body_hash=None):
+        #Keep the old validators (& hash) if the response didn't come with new ones
         with self.db as db:
-            db.execute('INSERT OR REPLACE INTO ExpireTimes VALUES (?, ?)',
-                  (appid, expires))
+            db.execute(UPSERT_EXPIRE_TIME, (appid, expires, etag, last_modified, body_hash))
 
-    def is_news_cached(self, appid):
-        c = self.db.execute('SELECT unixseconds FROM ExpireTimes WHERE appid = ?',
-                (appid,))
-        exptime = c.fetchone()
-        if exptime is None: #i.e. appid not found
-            return False
-        else:
-            #TODO maybe use datetime.timestamp() & now() instead?
-            return time.time() < exptime[0]
+    def get_due_games(self, now=None, limit=None):
+        """Get the games to fetch whose cache has expired (or never been filled),
+        most overdue first, along with the validators for a conditional request,
+        the hash of the last response's body, the date of the newest news item we have for each
+        and how many times in a row fetching it has failed."""
+        if now is None:
+            now = int(time.time())
+        c = self.db.execute('''SELECT appid, name, etag, last_modified, body_hash,
+                (SELECT max(date) FROM NewsSources JOIN NewsItems USING (gid)
+                    WHERE NewsSources.appid = Games.appid) AS last_post,
+                coalesce(failures, 0) AS failures
+            FROM Games LEFT JOIN ExpireTimes USING (appid)
+                LEFT JOIN FetchFailures USING (appid)
+            WHERE shouldFetch != 0 AND coalesce(unixseconds, 0) <= ?
+            ORDER BY coalesce(unixseconds, 0), appid LIMIT ?''',
+            (now, -1 if limit is None else limit))
+        return c.fetchall()
+
+    def get_next_due_time(self):
+        """When is the next game to fetch due (unixseconds; 0 if one never was fetched)?
+        None if there are no games to fetch."""
+        c = self.db.execute('''SELECT min(coalesce(unixseconds, 0))
+            FROM Games LEFT JOIN ExpireTimes USING (appid)
+            WHERE shouldFetch != 0''')
+        return c.fetchone()[0]
+
+    def count_cached_games(self, now=None):
+        """How many games to fetch are still within their cache time?"""
+        if now is None:
+            now = int(time.time())
+        c = self.db.execute('''SELECT count(*)
+            FROM Games JOIN ExpireTimes USING (appid)
+            WHERE shouldFetch != 0 AND unixseconds > ?''', (now,))
+        return c.fetchone()[0]
+
+    def _news_item_params(self, ned: dict):
+        contents = ned['contents']
+        compressed = 0
+        if self.compress and contents and len(contents) >= COMPRESS_MIN_LENGTH:
+            packed = zlib.compress(contents.encode('utf-8'))
+            if len(packed) < len(contents):
+                contents = packed
+                compressed = 1
+        return (ned['gid'], ned['title'], ned['url'], ned['is_external_url'],
+                ned['author'], contents, ned['feedlabel'], ned['date'],
+                ned['feedname'], ned['feed_type'], ned['appid'], compressed)
 
     def insert_news_item(self, ned: dict):
         #TODO maybe convert the dict to a namedtuple...?
         with self.db as db:
-            db.execute('''INSERT OR IGNORE INTO NewsItems
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (ned['gid'], ned['title'], ned['url'], ned['is_external_url'],
-                    ned['author'], ned['contents'], ned['feedlabel'], ned['date'],
-                    ned['feedname'], ned['feed_type'], ned['appid']))
+            db.execute(INSERT_NEWS_ITEM, self._news_item_params(ned))
+            db.execute(INSERT_NEWS_SOURCE, (ned['gid'], ned['realappid']))
+
+    def insert_news_source(self, gid, appid):
+        """Note that an item we already have was also posted for appid"""
+        with self.db as db:
+            db.execute(INSERT_NEWS_SOURCE, (gid, appid))
+
+    def get_recent_sources(self, cutoff):
+        """Get a cursor of (gid, appid) for each source of each news item
+        dated cutoff (unixseconds) or later; appid is NULL for an item without any"""
+        return self.db.execute('''SELECT gid, NewsSources.appid
+            FROM NewsItems LEFT JOIN NewsSources USING (gid) WHERE date >= ?''', (cutoff,))
 
-            db.execute('INSERT OR IGNORE INTO NewsSources VALUES (?, ?)',
-                    (ned['gid'], ned['realappid']))
+    def write_batch(self, expire_rows, neds, failure_rows=(), source_rows=()):
+        """Write a group of fetch results in one transaction.
+        expire_rows are (appid, expires, etag, last_modified, body_hash) tuples,
+        neds are news item dicts as for insert_news_item,
+        failure_rows are tuples as for record_failure,
+        source_rows are (gid, appid) pairs as for insert_news_source."""
+        with self.db as db:
+            db.executemany(UPSERT_EXPIRE_TIME, expire_rows)
+            #fetching worked, so any failure streak is over
+            db.executemany('DELETE FROM FetchFailures WHERE appid = ?',
+                    ((row[0],) for row in expire_rows))
+            db.executemany(UPSERT_FETCH_FAILURE, failure_rows)
+            #not due again until it's time to retry
+            db.executemany(UPSERT_EXPIRE_TIME,
+                    ((row[0], row[5], None, None, None) for row in failure_rows))
+            db.executemany(INSERT_NEWS_ITEM, map(self._news_item_params, neds))
+            db.executemany(INSERT_NEWS_SOURCE,
+                    ((ned['gid'], ned['realappid']) for ned in neds))
+            db.executemany(INSERT_NEWS_SOURCE, source_rows)
+
+    def record_failure(self, appid, failures, last_status, last_error, last_failed,
+            retry_at, parked=False):
+        """Note that fetching appid has now failed `failures` times in a row,
+        most recently at last_failed with last_status (HTTP status, or None)
+        & last_error; it won't be due again until retry_at"""
+        self.write_batch((), (), [(appid, failures, last_status, last_error, last_failed,
+                retry_at, parked)])
+
+    def get_fetch_failures(self):
+        """Get the games that have been failing to fetch, worst first"""
+        c = self.db.execute('''SELECT appid, name, failures, last_status, last_error,
+                last_failed, retry_at, parked
+            FROM FetchFailures JOIN Games USING (appid)
+            ORDER BY parked DESC, failures DESC, appid''')
+        return c.fetchall()
+
+    def reset_fetch_failures(self, appids=None):
+        """Forget the failures of the given games (or all of them),
+        making them due to be fetched again right away.
+        Returns how many games were reset."""
+        with self.db as db:
+            if appids is None:
+                appids = [row[0] for row in db.execute('SELECT appid FROM FetchFailures')]
+            db.executemany('UPDATE ExpireTimes SET unixseconds = 0 WHERE appid = ?',
+                    ((appid,) for appid in appids))
+            c = db.executemany('DELETE FROM FetchFailures WHERE appid = ?',
+                    ((appid,) for appid in appids))
+            return c.rowcount
+
+    def batch(self, size=50):
+        return NewsBatch(self, size)
 
     def get_news_rows(self):
-        #TODO generator shenanigans instead of fetchall()?
-        #sadly our sqlite3 version isn't new enough for unixepoch()
-        # so we have to use strftime('%s') for sqlite to make a unix timestamp
-        c = self.db.execute('''SELECT * FROM NewsItems
-            WHERE date >= strftime('%s', 'now', '-30 day')
+        """Get a cursor over the last 30 days of news items, newest first,
+        each with a `sources` column of its games' names joined by SOURCE_SEP
+        (in appid order; NULL if we somehow have no sources)
+        and the `html`, `content_hash` & `renderer` of its cached rendering, if any,
+        plus its cached `rsstitle` & the `title_sources` that was made from"""
+        #Sources are grouped in one pass instead of a query per item;
+        # the inner ORDER BY is what puts group_concat's names in appid order
+        return self.db.execute('''WITH Recent AS (''' + RECENT_NEWS + '''),
+            Sources AS (
+                SELECT gid, group_concat(name, char(31)) AS sources
+                FROM (SELECT gid, name FROM NewsSources JOIN Games USING (appid)
+                    WHERE gid IN (SELECT gid FROM Recent)
+                    ORDER BY gid, appid)
+                GROUP BY gid)
+            SELECT Recent.*, Sources.sources, html, content_hash, renderer,
+                rsstitle, RSSTitles.sources AS title_sources
+            FROM Recent LEFT JOIN Sources USING (gid)
+                LEFT JOIN RenderedHTML USING (gid) LEFT JOIN RSSTitles USING (gid)
             ORDER BY date DESC''')
-        return c.fetchall()
 
-    def get_source_names_for_item(self, gid):
-        c = self.db.execute('''SELECT name
-            FROM NewsSources NATURAL JOIN Games
-            WHERE gid = ? ORDER BY appid''', (gid,))
-        #fetchall gives a bunch of tuples, so we have to unpack them with a for loop...
-        return list(x[0] for x in c.fetchall())
+    def get_news_summary(self):
+        """Get a cursor over just enough of each item get_news_rows would return
+        to pick which feeds it goes in: its gid, date, feedname, feedlabel & feed_type,
+        plus `appids`, its sources' appids comma-separated in order (NULL if none).
+        Newest first, like get_news_rows."""
+        #All from NewsWindowIdx, newest first, with each item's sources
+        # in appid order straight from NewsSources' primary key
+        return self.db.execute('''SELECT gid, date, feedname, feedlabel, feed_type,
+                (SELECT group_concat(appid) FROM (SELECT appid FROM NewsSources
+                    WHERE NewsSources.gid = NewsItems.gid ORDER BY appid)) AS appids
+            FROM NewsItems WHERE ''' + RECENT_WINDOW + ''' ORDER BY date DESC''')
+
+    def get_publish_fingerprint(self, path):
+        c = self.db.execute('SELECT fingerprint FROM PublishState WHERE path = ?', (path,))
+        row = c.fetchone()
+        return row[0] if row else None
+
+    def set_publish_fingerprint(self, path, fingerprint):
+        with self.db as db:
+            db.execute('''INSERT OR REPLACE INTO PublishState(path, fingerprint)
+                VALUES (?, ?)''', (path, fingerprint))
+
+    def save_rendered_html(self, rendered):
+        """Given (gid, content_hash, renderer, html) tuples, cache them for get_news_rows"""
+        with self.db as db:
+            db.executemany('INSERT OR REPLACE INTO RenderedHTML VALUES (?, ?, ?, ?)',
+                    rendered)
+
+    def prune_news(self, max_age_days=None, max_items=None):
+        """Delete news items older than max_age_days and/or beyond the newest max_items.
+        Their sources & cached renderings go with them (via ON DELETE CASCADE).
+        Returns how many items were deleted."""
+        deleted = 0
+        with self.db as db:
+            if max_age_days is not None:
+                c = db.execute('''DELETE FROM NewsItems
+                    WHERE date < strftime('%s', 'now', ?)''',
+                    ('-{} day'.format(int(max_age_days)),))
+                deleted += c.rowcount
+            if max_items is not None:
+                c = db.execute('''DELETE FROM NewsItems WHERE gid NOT IN
+                    (SELECT gid FROM NewsItems ORDER BY date DESC LIMIT ?)''',
+                    (max_items,))
+                deleted += c.rowcount
+        logger.info('Pruned %d old news items.', deleted)
+        return deleted
+
+    def incremental_vacuum(self):
+        """Give free pages back to the OS, if the DB uses incremental auto_vacuum"""
+        if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] == 2: #INCREMENTAL
+            #execute() only steps this once, freeing a single page;
+            # executescript() runs it to completion
+            self.db.executescript('PRAGMA incremental_vacuum')
+
+    def vacuum(self, incremental=True):
+        """Rebuild the whole DB, switching it to incremental auto_vacuum along the way"""
+        self.db.commit()
+        if incremental:
+            self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        logger.info('Vacuuming DB...')
+        self.db.execute('VACUUM')
+
+    def save_titles(self, titles):
+        """Given (gid, sources, rsstitle) tuples, cache them for get_news_rows"""
+        with self.db as db:
+            db.executemany('INSERT OR REPLACE INTO RSSTitles VALUES (?, ?, ?)', titles)
+
+    def add_run_history(self, report: dict, keep=RUN_HISTORY_KEEP):
+        """Record a run's report, dropping all but the newest `keep` of them"""
+        with self.db as db:
+            c = db.execute('INSERT INTO RunHistory(started, seconds, report) VALUES (?, ?, ?)',
+                    (report['started'], report['seconds'], json.dumps(report)))
+            db.execute('DELETE FROM RunHistory WHERE runid <= ?', (c.lastrowid - keep,))
+
+    def get_run_history(self, limit=20):
+        """Get the latest run reports, newest first"""
+        c = self.db.execute('SELECT report FROM RunHistory ORDER BY runid DESC LIMIT ?',
+                (limit,))
+        return [json.loads(row[0]) for row in c]
+
+
+class NewsBatch:
+    """Stand-in for NewsDatabase's fetch writes (update_expire_time, insert_news_item,
+    insert_news_source & record_failure) that buffers them & commits once every `size` apps
+    instead of every statement.
+    Anything still buffered is written when the with block ends."""
+    def __init__(self, db: NewsDatabase, size=50):
+        self.db = db
+        self.size = size
+        self.expire_rows = []
+        self.neds = []
+        self.failure_rows = []
+        self.source_rows = []
+
+    def update_expire_time(self, appid, expires, etag=None, last_modified=None,
+            body_hash=None):
+        #each app starts with its expiry, so flushing here keeps an app's items together
+        if len(self.expire_rows) + len(self.failure_rows) >= self.size:
+            self.flush()
+        self.expire_rows.append((appid, expires, etag, last_modified, body_hash))
+
+    def insert_news_item(self, ned: dict):
+        self.neds.append(ned)
+
+    def insert_news_source(self, gid, appid):
+        self.source_rows.append((gid, appid))
+
+    def record_failure(self, *failure):
+        if len(self.expire_rows) + len(self.failure_rows) >= self.size:
+            self.flush()
+        self.failure_rows.append(failure)
+
+    def flush(self):
+        if self.expire_rows or self.neds or self.failure_rows or self.source_rows:
+            logger.debug('Writing %d apps, %d news items, %d sources & %d failures...',
+                    len(self.expire_rows), len(self.neds), len(self.source_rows),
+                    len(self.failure_rows))
+            self.db.write_batch(self.expire_rows, self.neds, self.failure_rows,
+                    self.source_rows)
+            self.expire_rows = []
+            self.neds = []
+            self.failure_rows = []
+            self.source_rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        return False
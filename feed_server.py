@@ -0,0 +1,132 @@
+import gzip
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+def feedURLPath(path):
+    """Where a feed published to path gets served, e.g. /steam_news.xml"""
+    return '/' + os.path.basename(path)
+
+
+class ServedFeed:
+    """A published feed, ready to send as is (or pre-gzipped) with its validators"""
+    def __init__(self, fingerprint, xml, modified=None):
+        self.fingerprint = fingerprint
+        self.xml = xml
+        self.gzipped = gzip.compress(xml)
+        self.etag = '"{}"'.format(fingerprint)
+        self.gzip_etag = '"{}-gzip"'.format(fingerprint)
+        self.modified = int(modified if modified is not None else time.time())
+        self.last_modified = formatdate(self.modified, usegmt=True)
+
+    def not_modified(self, headers):
+        """Would a request with these headers be satisfied by what the client has?"""
+        if_none_match = headers.get('If-None-Match')
+        if if_none_match is not None:
+            #If-Modified-Since is ignored when there's an If-None-Match
+            tags = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+            return '*' in tags or self.etag in tags or self.gzip_etag in tags
+        if_modified_since = headers.get('If-Modified-Since')
+        if if_modified_since is not None:
+            try:
+                return parsedate_to_datetime(if_modified_since).timestamp() >= self.modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    server_version = 'SteamNews'
+    protocol_version = 'HTTP/1.1' #so feed readers can keep connections open
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.send_feed(head=True)
+
+    def do_GET(self):
+        self.send_feed()
+
+    def send_feed(self, head=False):
+        #Just a dict lookup; the dict is only ever swapped out whole by FeedServer.update
+        feed = self.server.feeds.get(urlsplit(self.path).path)
+        if feed is None:
+            body = b'Not Found'
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        not_modified = feed.not_modified(self.headers)
+        body = feed.gzipped if use_gzip else feed.xml
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', feed.gzip_etag if use_gzip else feed.etag)
+        self.send_header('Last-Modified', feed.last_modified)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', 'no-cache')
+        if not_modified:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+class FeedServer:
+    """Serves published feeds from memory over HTTP, on a background thread;
+    use as a context manager.
+    The DB is never touched here: whoever publishes hands the results to update()."""
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.server = ThreadingHTTPServer((host, port), FeedHandler)
+        self.server.daemon_threads = True
+        self.server.feeds = {}
+        self.thread = None
+
+    def update(self, published: dict):
+        """Serve what publish_feeds put in its in_memory dict, {path: (fingerprint, xml)}.
+        Feeds whose fingerprint didn't change keep their old Last-Modified."""
+        old = self.server.feeds
+        feeds = {}
+        for path, (fingerprint, xml) in published.items():
+            url = feedURLPath(path)
+            if url in old and old[url].fingerprint == fingerprint:
+                feeds[url] = old[url]
+            else:
+                feeds[url] = ServedFeed(fingerprint, xml)
+        #swapping the whole dict in means requests never see it half updated
+        self.server.feeds = feeds
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info('Serving feeds on http://%s:%d/', host, port)
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+#How many of the slowest fetches to keep in a run's report
+SLOWEST_FETCHES = 20
+
+
+class RunMetrics:
+    """Timings & counts for one run of fetching and/or publishing.
+    Phase times are summed over the run; the fetch phases (http, json decode)
+    are summed over all workers, so they can add up to more than the run took."""
+    def __init__(self):
+        self.started = time.time()
+        self.start_counter = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.fetches = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - start
+
+    def add_time(self, name, seconds):
+        self.phases[name] += seconds
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def record_fetch(self, appid, stats: dict):
+        """Note how fetching one app went; stats as from SteamNews.getNewsForAppID"""
+        self.fetches.append({'appid': appid, **{k: round(v, 4) if isinstance(v, float) else v
+                for k, v in stats.items()}})
+        self.add_time('http', stats.get('http', 0))
+        self.add_time('json decode', stats.get('decode', 0))
+        self.count('response bytes', stats.get('bytes', 0))
+
+    def report(self):
+        """Summarize the run as a JSON-friendly dict"""
+        statuses = defaultdict(int)
+        for f in self.fetches:
+            statuses[str(f.get('status'))] += 1
+        latencies = sorted(f.get('http', 0) for f in self.fetches)
+        slowest = sorted(self.fetches, key=lambda f: f.get('http', 0), reverse=True)
+        return {
+            'started': int(self.started),
+            'seconds': round(time.perf_counter() - self.start_counter, 4),
+            'phases': {name: round(secs, 4) for name, secs in sorted(self.phases.items())},
+            'counts': dict(sorted(self.counts.items())),
+            'http_statuses': dict(sorted(statuses.items())),
+            'fetch_latency': {
+                'median': latencies[len(latencies) // 2] if latencies else None,
+                'p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+                'max': latencies[-1] if latencies else None,
+            },
+            'slowest_fetches': slowest[:SLOWEST_FETCHES],
+        }
+
+    def write_json(self, path, report=None):
+        report = report or self.report()
+        _write_atomically(path, json.dumps(report, indent=2) + '\n')
+        logger.info('Wrote run report to %s', path)
+
+    def write_prometheus(self, path, report=None):
+        """Write the run's numbers in Prometheus' text format,
+        for node_exporter's textfile collector"""
+        report = report or self.report()
+        lines = [
+            '# HELP steamnews_last_run_timestamp_seconds When the last run started.',
+            '# TYPE steamnews_last_run_timestamp_seconds gauge',
+            'steamnews_last_run_timestamp_seconds {}'.format(report['started']),
+            '# HELP steamnews_run_seconds How long the last run took.',
+            '# TYPE steamnews_run_seconds gauge',
+            'steamnews_run_seconds {}'.format(report['seconds']),
+            '# HELP steamnews_phase_seconds Time spent in each phase of the last run.',
+            '# TYPE steamnews_phase_seconds gauge',
+        ]
+        lines.extend('steamnews_phase_seconds{{phase="{}"}} {}'.format(name, secs)
+                for name, secs in report['phases'].items())
+        lines.extend(('# HELP steamnews_run_count Things counted during the last run.',
+                '# TYPE steamnews_run_count gauge'))
+        lines.extend('steamnews_run_count{{what="{}"}} {}'.format(name, n)
+                for name, n in report['counts'].items())
+        lines.extend(('# HELP steamnews_http_responses Responses by HTTP status in the last run.',
+                '# TYPE steamnews_http_responses gauge'))
+        lines.extend('steamnews_http_responses{{status="{}"}} {}'.format(status, n)
+                for status, n in report['http_statuses'].items())
+        _write_atomically(path, '\n'.join(lines) + '\n')
+        logger.info('Wrote Prometheus metrics to %s', path)
+
+
+def _write_atomically(path, text):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -3,5 +3,6 @@ set -e
 
 cd -- "$(dirname -- "${BASH_SOURCE[0]}" )"
 source bin/activate
-./SteamNews.py --verbose --fetch --publish steam_news.xml &> log_steam_news.log
-cp steam_news.xml /mnt/dav/news/steam_news.xml
+./SteamNews.py fetch --verbose --publish steam_news.xml &> log_steam_news.log
+#-u: publishing leaves the file alone when nothing changed, so skip the copy too
+cp -u steam_news.xml /mnt/dav/news/steam_news.xml